@@ -7,47 +7,2618 @@
 
 from __future__ import print_function
 
+import os
+import re
 import sys
+import copy
+import json
 import time
+import random
+import hashlib
 import argparse
-import boto3
-from botocore.exceptions import ClientError
+import threading
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from datetime import datetime
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 
+DEFAULT_TIMEOUT = 90
+DEFAULT_WORKERS = 10
+DEFAULT_FAILURE_THRESHOLD = 3
+DEFAULT_DEREGISTER_RATE = 5
+DEFAULT_SERVICE_INDEX_TTL = 300
+DEFAULT_TASK_DEFINITION_CACHE_SIZE = 64
+DEFAULT_READ_RATE = 20
+DEFAULT_WRITE_RATE = 5
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_DIGEST_CACHE_TTL = 60
+DEFAULT_CLUSTER_CONCURRENCY = 2
+DEFAULT_CREDENTIAL_REFRESH_MARGIN = 900
+# the serve command's Unix socket, in the cache directory
+DEFAULT_SOCKET = 'daemon.sock'
+DEFAULT_JOB_HISTORY = 1000
+
+# error codes of ECS API calls rejected for exceeding a rate limit
+THROTTLING_ERRORS = frozenset([
+    'Throttling', 'ThrottlingException', 'ThrottledException', 'RequestLimitExceeded',
+    'TooManyRequestsException', 'RequestThrottled', 'RequestThrottledException'])
+
+# ECS client functions that act on the --cluster
+CLUSTER_SCOPED_CALLS = frozenset([
+    'list_services', 'describe_services', 'update_service', 'list_tasks', 'describe_tasks',
+    'list_container_instances', 'describe_container_instances'])
+
+# kwargs that are the same for every call of an ECS client function
+STATIC_KWARGS = {
+    'list_task_definitions': {'status': 'ACTIVE', 'sort': 'DESC'},
+    # the largest page ECS allows, rather than the default of 10
+    'list_services': {'maxResults': 100},
+}
+
+# task definition fields carried over into a new revision
+REGISTRATION_FIELDS = ('family', 'containerDefinitions')
+MAX_DESCRIBE_SERVICES = 10
+MAX_DESCRIBE_TASKS = 100
+MAX_DESCRIBE_CONTAINER_INSTANCES = 100
+MAX_BATCH_GET_IMAGE = 100
+
+# registry id, region, repository and tag of an image in ECR
+ECR_IMAGE = re.compile(r'^(\d+)\.dkr\.ecr\.([a-z0-9-]+)\.amazonaws\.com(?:\.cn)?/'
+                       r'([^:@]+)(?::([^:@/]+))?$')
+
+# an interrupted deploy older than this is started afresh rather than resumed
+JOURNAL_RESUME_WINDOW = 3600
+
+# format of plan files, and the parts of a described service a plan keeps
+PLAN_VERSION = 1
+PLAN_SERVICE_KEYS = ('serviceName', 'taskDefinition', 'desiredCount', 'launchType',
+                     'deploymentConfiguration')
+
+
+# deadlines must not move with wall clock adjustments
+monotonic = getattr(time, 'monotonic', time.time)
+
+# held while Deployer._create_client builds a boto3 client
+client_lock = threading.Lock()
+
+
+class PollScheduler(object):
+    """Schedules polls against a deadline.
+
+    Polls every ``min_interval`` seconds while the watched state is changing and
+    backs off exponentially, with jitter, up to ``max_interval`` while it is
+    stable. The final sleep is clamped so that it ends exactly at the deadline.
+    """
+
+    def __init__(self, timeout, min_interval=1.0, max_interval=15.0, factor=2.0,
+                 jitter=0.2, clock=monotonic, sleep=time.sleep):
+        self.clock = clock
+        self.sleep = sleep
+        self.deadline = clock() + timeout
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.factor = factor
+        self.jitter = jitter
+        self.interval = min_interval
+
+    def remaining(self):
+        return max(0.0, self.deadline - self.clock())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def next_delay(self, changed):
+        if changed:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * self.factor, self.max_interval)
+        delay = self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+        return min(delay, self.remaining())
+
+    def wait(self, changed):
+        delay = self.next_delay(changed)
+        if delay > 0:
+            self.sleep(delay)
+
+
+class EventFollower(object):
+    """Follows a service's event stream across describe_services polls.
+
+    ECS returns a service's latest events newest first, including ones already
+    seen; :meth:`follow` yields only the events after the last one it yielded
+    (or, initially, from ``since`` on), oldest first.
+    """
+
+    def __init__(self, since=None):
+        self.last_id = None
+        self.last_at = since
+
+    def follow(self, service):
+        new = []
+        for event in service.get('events', []):
+            if event['id'] == self.last_id or \
+                    (self.last_at is not None and event['createdAt'] < self.last_at):
+                break
+            new.append(event)
+        if new:
+            self.last_id = new[0]['id']
+            self.last_at = new[0]['createdAt']
+        for event in reversed(new):
+            yield event
+
+
+def format_event(service_name, event, format='text'):
+    created = event['createdAt']
+    created = created.isoformat() if hasattr(created, 'isoformat') else str(created)
+    if format == 'json':
+        return json.dumps({'service': service_name, 'id': event['id'], 'createdAt': created,
+                           'message': event['message']}, sort_keys=True)
+    return '%s %s' % (created, event['message'])
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket allowing ``rate`` acquisitions per second on
+    average, in bursts of up to ``capacity``.
+    """
+
+    def __init__(self, rate, capacity=None, clock=monotonic, sleep=time.sleep):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(1.0, rate))
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        # take a token, sleeping outside the lock until one is available
+        while True:
+            with self._lock:
+                now = self.clock()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            self.sleep(delay)
+
+
+class RateLimiter(object):
+    """Separate token buckets for read (describe/list) and mutating ECS calls.
+
+    One limiter is shared by every call of a deploy, however many threads make
+    them, so that concurrent deploys stay within the API's rate limits.
+    """
+
+    def __init__(self, read_rate=DEFAULT_READ_RATE, write_rate=DEFAULT_WRITE_RATE):
+        self.read = TokenBucket(read_rate, read_rate * 2)
+        self.write = TokenBucket(write_rate, write_rate * 2)
+
+    def acquire(self, fn):
+        bucket = self.read if fn.startswith(('describe_', 'list_')) else self.write
+        bucket.acquire()
+
+
+def retryable_error(error):
+    # throttling and server side errors are worth retrying, anything else
+    # would fail again
+    response = getattr(error, 'response', None) or {}
+    code = response.get('Error', {}).get('Code')
+    status = response.get('ResponseMetadata', {}).get('HTTPStatusCode') or 0
+    return code in THROTTLING_ERRORS or status >= 500
+
+
+def retry_delay(attempt, base=0.5, cap=20.0):
+    # exponential backoff with full jitter
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class Metrics(object):
+    """Thread-safe record of ECS API calls and of the time spent in deploy phases.
+
+    Written as JSON lines, one object per call and per service phase, or as a
+    Prometheus textfile of totals by call and phase.
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.phases = []
+        self.retries = []
+        self._lock = threading.Lock()
+
+    def record_call(self, fn, phase, service, latency, retries, size, error=None):
+        with self._lock:
+            self.calls.append({'type': 'call', 'call': fn, 'phase': phase, 'service': service,
+                               'latency': latency, 'retries': retries, 'bytes': size,
+                               'error': error})
+
+    def record_retry(self, fn, code, delay):
+        with self._lock:
+            self.retries.append({'type': 'retry', 'call': fn, 'code': code, 'delay': delay})
+
+    def retry_totals(self):
+        # {(call, error code): (retries, seconds spent backing off)}
+        totals = {}
+        for record in self.retries:
+            key = (record['call'], record['code'])
+            count, delay = totals.get(key, (0, 0.0))
+            totals[key] = (count + 1, delay + record['delay'])
+        return totals
+
+    def record_phase(self, phase, service, seconds):
+        with self._lock:
+            self.phases.append({'type': 'phase', 'phase': phase, 'service': service,
+                                'seconds': seconds})
+
+    def phase_totals(self):
+        totals = {}
+        for record in self.phases:
+            totals[record['phase']] = totals.get(record['phase'], 0.0) + record['seconds']
+        return totals
+
+    def to_json_lines(self):
+        return ''.join(json.dumps(record, sort_keys=True) + '\n'
+                       for record in self.calls + self.retries + self.phases)
+
+    def to_prometheus(self):
+        totals = {}
+        for call in self.calls:
+            key = (call['call'], call['phase'] or '')
+            count, latency, retries, size, errors = totals.get(key, (0, 0.0, 0, 0, 0))
+            totals[key] = (count + 1, latency + call['latency'], retries + call['retries'],
+                           size + call['bytes'], errors + bool(call['error']))
+
+        lines = []
+        metrics = [('api_calls_total', 'ECS API calls.'),
+                   ('api_call_seconds_total', 'Time spent in ECS API calls.'),
+                   ('api_retries_total', 'Retries of ECS API calls.'),
+                   ('api_response_bytes_total', 'Size of ECS API responses.'),
+                   ('api_errors_total', 'Failed ECS API calls.')]
+        for i, (name, help_text) in enumerate(metrics):
+            lines.append('# HELP ecs_deploy_%s %s' % (name, help_text))
+            lines.append('# TYPE ecs_deploy_%s counter' % name)
+            for (fn, phase), values in sorted(totals.items()):
+                lines.append('ecs_deploy_%s{call="%s",phase="%s"} %s' % (name, fn, phase,
+                                                                      values[i]))
+        lines.append('# HELP ecs_deploy_client_retries_total Calls retried after throttling '
+                     'or server errors.')
+        lines.append('# TYPE ecs_deploy_client_retries_total counter')
+        for (fn, code), (count, delay) in sorted(self.retry_totals().items()):
+            lines.append('ecs_deploy_client_retries_total{call="%s",code="%s"} %s' %
+                         (fn, code, count))
+        lines.append('# HELP ecs_deploy_phase_seconds Time spent in each deploy phase.')
+        lines.append('# TYPE ecs_deploy_phase_seconds gauge')
+        for phase, seconds in sorted(self.phase_totals().items()):
+            lines.append('ecs_deploy_phase_seconds{phase="%s"} %s' % (phase, seconds))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path, format='json'):
+        # through a temporary file, so textfile collectors never read a partial file
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(self.to_prometheus() if format == 'prometheus' else self.to_json_lines())
+        os.rename(tmp, path)
+
+
+def cassette_key(fn, kwargs):
+    return json.dumps([fn, kwargs], sort_keys=True, default=str)
+
+
+class Cassette(object):
+    """Records ECS calls, as JSON lines, for :class:`ReplayClient` to serve.
+
+    Each line holds the ``call``, its ``request`` kwargs, the ``response`` or
+    the ``error`` response of a failed call, and its ``latency``. Lines are
+    written as calls return, so an interrupted deploy still leaves a cassette.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.started = False
+        self.lock = threading.Lock()
+
+    def record(self, fn, request, response, error, latency):
+        if error is not None:
+            error = getattr(error, 'response', None) or \
+                {'Error': {'Code': error.__class__.__name__, 'Message': str(error)}}
+        line = json.dumps({'call': fn, 'request': request, 'response': response,
+                           'error': error, 'latency': latency}, sort_keys=True, default=str)
+        with self.lock:
+            with open(self.path, 'a' if self.started else 'w') as f:
+                f.write(line + '\n')
+            self.started = True
+
+
+class ReplayClient(object):
+    """Serves the responses of a :class:`Cassette` in place of an ECS client.
+
+    Calls are matched on their name and kwargs. Repeats of a call get its
+    recorded responses in order and then the last one again, so a replayed
+    deploy may poll any number of times. Every call takes ``latency`` seconds.
+    """
+
+    def __init__(self, path, latency=0.0, region_name=None, sleep=time.sleep):
+        self.latency = latency
+        self.sleep = sleep
+        self.meta = namedtuple('ClientMeta', 'region_name')(region_name)
+        self.interactions = {}
+        self.served = {}
+        self.lock = threading.Lock()
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    interaction = json.loads(line)
+                    self.interactions.setdefault(
+                        cassette_key(interaction['call'], interaction['request']),
+                        []).append(interaction)
+
+    def __getattr__(self, fn):
+        if fn.startswith('_'):
+            raise AttributeError(fn)
+        return lambda **kwargs: self._serve(fn, kwargs)
+
+    def _serve(self, fn, kwargs):
+        key = cassette_key(fn, kwargs)
+        with self.lock:
+            interactions = self.interactions.get(key)
+            if not interactions:
+                raise DeployError('No recorded response to %s %s.' % (fn, key))
+            served = self.served.get(key, 0)
+            interaction = interactions[min(served, len(interactions) - 1)]
+            self.served[key] = served + 1
+        if self.latency:
+            self.sleep(self.latency)
+        if interaction['error']:
+            from botocore.exceptions import ClientError
+            raise ClientError(interaction['error'], fn)
+        return interaction['response']
+
+
+class TaskDefinitionCache(object):
+    """Least recently used cache of task definitions, keyed by revision ARN.
+
+    Registered revisions never change, so entries cannot go stale and are only
+    evicted, least recently used first, once the cache exceeds ``max_bytes``.
+    The cache is best effort: any SQLite error is treated as a miss. It serves
+    describes of revision ARNs only (``-d`` with an ARN, and resumed deploys):
+    the latest revision of a family can change, and finding out which it is
+    costs the same call as describing it.
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+
+    def _connect(self):
+        import sqlite3
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.execute('CREATE TABLE IF NOT EXISTS task_definitions ('
+                     'arn TEXT PRIMARY KEY, body TEXT NOT NULL, '
+                     'size INTEGER NOT NULL, used REAL NOT NULL)')
+        return conn
+
+    def get(self, arn):
+        import sqlite3
+        try:
+            conn = self._connect()
+            try:
+                with conn:
+                    row = conn.execute('SELECT body FROM task_definitions WHERE arn = ?',
+                                       (arn,)).fetchone()
+                    if row:
+                        conn.execute('UPDATE task_definitions SET used = ? WHERE arn = ?',
+                                     (time.time(), arn))
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            return None
+        return json.loads(row[0]) if row else None
+
+    def put(self, task_definition):
+        import sqlite3
+        body = json.dumps(task_definition, separators=(',', ':'), default=str)
+        try:
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.execute('INSERT OR REPLACE INTO task_definitions VALUES (?, ?, ?, ?)',
+                                 (task_definition['taskDefinitionArn'], body, len(body),
+                                  time.time()))
+                    self._evict(conn)
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            pass
+
+    def _evict(self, conn):
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM task_definitions').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = conn.execute('SELECT arn, size FROM task_definitions ORDER BY used').fetchall()
+        for arn, size in rows:
+            if total <= self.max_bytes:
+                break
+            conn.execute('DELETE FROM task_definitions WHERE arn = ?', (arn,))
+            total -= size
+
+
+class DeployJournal(object):
+    """Journal of deploys, kept in SQLite.
+
+    Each deploy of a service is a row holding the revision the service ran
+    before (``old_arn``), the revision it was rolled out to (``new_arn``), the
+    last phase it finished (``register`` or ``update``) and, once it is over,
+    its ``status`` and ``cause``. A row without a status is a deploy that was
+    interrupted. Like the task definition cache, the journal is best effort:
+    SQLite errors are ignored.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _run(self, fn):
+        import sqlite3
+        try:
+            conn = sqlite3.connect(self.path, timeout=10)
+            try:
+                conn.row_factory = sqlite3.Row
+                with conn:
+                    conn.execute('CREATE TABLE IF NOT EXISTS deploys ('
+                                 'id INTEGER PRIMARY KEY AUTOINCREMENT, region TEXT, '
+                                 'cluster TEXT, service TEXT, image TEXT, old_arn TEXT, '
+                                 'new_arn TEXT, phase TEXT, status TEXT, cause TEXT, '
+                                 'started REAL NOT NULL, updated REAL NOT NULL)')
+                    return fn(conn)
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            return None
+
+    def start(self, target, image, old_arn, new_arn):
+        # record a registered revision of (region, cluster, service); returns
+        # the deploy's id
+        now = time.time()
+        return self._run(lambda conn: conn.execute(
+            'INSERT INTO deploys (region, cluster, service, image, old_arn, new_arn, phase, '
+            'started, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            tuple(target) + (image, old_arn, new_arn, 'register', now, now)).lastrowid)
+
+    def record(self, deploy_id, **fields):
+        # update the phase, status or cause of a deploy
+        fields['updated'] = time.time()
+        names = sorted(fields)
+        self._run(lambda conn: conn.execute(
+            'UPDATE deploys SET %s WHERE id = ?' % ', '.join('%s = ?' % n for n in names),
+            [fields[n] for n in names] + [deploy_id]))
+
+    def interrupted(self, target, image, window=JOURNAL_RESUME_WINDOW):
+        # the latest deploy of image to target that never finished, if it was
+        # last updated within window seconds
+        return self._row(
+            'SELECT * FROM deploys WHERE region = ? AND cluster = ? AND service = ? '
+            'AND image = ? AND status IS NULL AND updated >= ? ORDER BY id DESC LIMIT 1',
+            tuple(target) + (image, time.time() - window))
+
+    def last_rollout(self, target):
+        # the latest deploy that updated the service of target and has not been
+        # rolled back
+        return self._row(
+            'SELECT * FROM deploys WHERE region = ? AND cluster = ? AND service = ? '
+            'AND phase = ? AND (status IS NULL OR status != ?) ORDER BY id DESC LIMIT 1',
+            tuple(target) + ('update', 'rolled_back'))
+
+    def _row(self, sql, params):
+        def fetch(conn):
+            row = conn.execute(sql, params).fetchone()
+            return dict(zip(row.keys(), row)) if row else None
+        return self._run(fetch)
+
+
+class CredentialCache(object):
+    """Cache of assumed role credentials, shared by every run on the machine.
+
+    botocore's assume-role provider checks ``key in cache``, calls STS on a
+    miss and stores the response with ``cache[key] = response``. Entries are
+    JSON files in ``path``, readable by the user only, and an entry within
+    ``margin`` seconds of expiring is a miss. A miss holds an exclusive lock on
+    the key's lock file until fresh credentials are stored, so that concurrent
+    processes wait for one AssumeRole instead of each making their own. No
+    one waits for the lock longer than ``lock_timeout`` seconds, in case its
+    holder never stores credentials. Without fcntl nothing is locked.
+    """
+
+    def __init__(self, path, prefix='', margin=DEFAULT_CREDENTIAL_REFRESH_MARGIN,
+                 lock_timeout=60.0):
+        self.path = path
+        self.prefix = prefix
+        self.margin = margin
+        self.lock_timeout = lock_timeout
+        self.locks = {}
+
+    def __contains__(self, key):
+        self._lock(key)
+        if self._read(key) is None:
+            # locked until __setitem__ stores the credentials fetched instead
+            return False
+        self._unlock(key)
+        return True
+
+    def __getitem__(self, key):
+        response = self._read(key)
+        if response is None:
+            raise KeyError(key)
+        return response
+
+    def __setitem__(self, key, response):
+        try:
+            tmp = '%s.%d.tmp' % (self._file(key), os.getpid())
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(response, f, default=lambda value: value.isoformat())
+            os.rename(tmp, self._file(key))
+        except (IOError, OSError):
+            pass
+        finally:
+            self._unlock(key)
+
+    def _file(self, key, suffix='.json'):
+        return os.path.join(self.path, '%s%s%s' % (self.prefix, key.replace(os.sep, '_'), suffix))
+
+    def _read(self, key):
+        from botocore.utils import parse_timestamp
+        from dateutil.tz import tzutc
+        try:
+            with open(self._file(key)) as f:
+                response = json.load(f)
+            expiration = parse_timestamp(response['Credentials']['Expiration'])
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return None
+        if (expiration - datetime.now(tzutc())).total_seconds() <= self.margin:
+            return None
+        return response
+
+    def _lock(self, key):
+        try:
+            import fcntl
+        except ImportError:
+            return
+        self._unlock(key)
+        try:
+            fd = os.open(self._file(key, '.lock'), os.O_RDWR | os.O_CREAT, 0o600)
+        except OSError:
+            return
+        deadline = monotonic() + self.lock_timeout
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                self.locks[key] = fd
+                return
+            except (IOError, OSError):
+                if monotonic() >= deadline:
+                    # go on unlocked rather than wait for a lock never released
+                    os.close(fd)
+                    return
+                time.sleep(0.05)
+
+    def _unlock(self, key):
+        fd = self.locks.pop(key, None)
+        if fd is not None:
+            import fcntl
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+
+class ClusterCapacity(object):
+    """Free CPU and memory of a cluster's container instances.
+
+    ``load`` returns ``[cpu, memory]`` for each instance and is called on first
+    use. :meth:`place` takes the reservations of the tasks it places from the
+    instances they fit on, so that the services of one deploy are checked
+    against the capacity the others leave.
+    """
+
+    def __init__(self, load):
+        self.load = load
+        self.free = None
+        self.lock = threading.Lock()
+
+    def place(self, cpu, memory, count):
+        # how many of count tasks fit, first fit; None if the cluster has no
+        # container instances (e.g. it only runs Fargate tasks)
+        with self.lock:
+            if self.free is None:
+                self.free = self.load()
+            if not self.free:
+                return None
+            placed = 0
+            for free in self.free:
+                while placed < count and free[0] >= cpu and free[1] >= memory:
+                    free[0] -= cpu
+                    free[1] -= memory
+                    placed += 1
+            return placed
+
+
+def task_reservation(task_definition):
+    # (cpu units, MiB of memory) a task of the definition reserves on an
+    # instance; task level sizes, where set, take precedence
+    containers = task_definition.get('containerDefinitions', [])
+    reservation = [sum(c.get('cpu') or 0 for c in containers),
+                   sum(c.get('memoryReservation') or c.get('memory') or 0 for c in containers)]
+    for i, key in enumerate(('cpu', 'memory')):
+        try:
+            reservation[i] = int(task_definition[key])
+        except (KeyError, TypeError, ValueError):
+            pass
+    return tuple(reservation)
+
+
+def rollout_placements(service, desired_count=None, minimum_healthy_percent=None):
+    # new tasks a rollout must place on free capacity before it can progress:
+    # the tasks it adds to the service or, if it adds none, one to replace the
+    # first old task when minimumHealthyPercent does not let any stop first
+    running = service.get('desiredCount', 0)
+    desired = running if desired_count is None else desired_count
+    if minimum_healthy_percent is None:
+        minimum_healthy_percent = service.get('deploymentConfiguration', {}).get(
+            'minimumHealthyPercent', 100)
+    healthy = -(-desired * minimum_healthy_percent // 100)
+    stoppable = max(0, running - healthy)
+    return max(0, desired - running) or (1 if desired and not stoppable else 0)
+
+
+class ImageResolver(object):
+    """Resolves tags of ECR images to digests, so that a rollout cannot pick up
+    a tag that is pushed again while it runs.
+
+    ``call(region, fn, **kwargs)`` makes ECR calls. Tags are looked up with one
+    batch_get_image call per repository (per MAX_BATCH_GET_IMAGE tags). A tag
+    resolves to the same digest for the life of the resolver, so every service
+    of a run gets the same image, and digests are reused from ``cache_path`` by
+    later runs for ``ttl`` seconds. Images that are not in ECR or are already
+    pinned resolve to themselves.
+    """
+
+    def __init__(self, call, cache_path=None, ttl=DEFAULT_DIGEST_CACHE_TTL):
+        self.call = call
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self.resolved = {}
+        self.lock = threading.Lock()
+
+    def resolve(self, images):
+        # {image: pinned image} for every image
+        with self.lock:
+            missing = [image for image in set(images)
+                       if image not in self.resolved and ECR_IMAGE.match(image)]
+            cache = self._read_cache() if missing else {}
+            for image in missing:
+                if image in cache:
+                    self.resolved[image] = cache[image][0]
+            missing = [image for image in missing if image not in self.resolved]
+            if missing:
+                now = time.time()
+                for image, pinned in self._look_up(missing).items():
+                    self.resolved[image] = pinned
+                    cache[image] = [pinned, now]
+                if self.cache_path and self.ttl:
+                    write_cache(self.cache_path, cache)
+            return dict((image, self.resolved.get(image, image)) for image in images)
+
+    def _read_cache(self):
+        # {image: [pinned image, time resolved]} of the digests still fresh
+        if not (self.cache_path and self.ttl):
+            return {}
+        now = time.time()
+        return dict((image, entry) for image, entry in
+                    (read_cache(self.cache_path, self.ttl) or {}).items()
+                    if now - entry[1] <= self.ttl)
+
+    def _look_up(self, images):
+        # repositories are looked up concurrently, each in as few calls as
+        # batch_get_image allows
+        repositories = {}
+        for image in sorted(images):
+            registry, region, repository, tag = ECR_IMAGE.match(image).groups()
+            repositories.setdefault((registry, region, repository), []).append(
+                (image, tag or 'latest', image.rsplit(':', 1)[0] if tag else image))
+        with ThreadPoolExecutor(max_workers=max(1, min(len(repositories),
+                                                       DEFAULT_WORKERS))) as executor:
+            pinned = {}
+            for batches in executor.map(self._look_up_repository, repositories.items()):
+                pinned.update(batches)
+            return pinned
+
+    def _look_up_repository(self, item):
+        (registry, region, repository), images = item
+        pinned = {}
+        for i in range(0, len(images), MAX_BATCH_GET_IMAGE):
+            batch = dict((tag, (image, name))
+                         for image, tag, name in images[i:i + MAX_BATCH_GET_IMAGE])
+            response = self.call(region, 'batch_get_image', registryId=registry,
+                                 repositoryName=repository,
+                                 imageIds=[{'imageTag': tag} for tag in sorted(batch)])
+            for failure in response.get('failures', []):
+                raise DeployError('Cannot resolve %s:%s to a digest: %s' % (
+                    repository, failure['imageId'].get('imageTag'), failure['failureReason']))
+            for found in response['images']:
+                image, name = batch[found['imageId']['imageTag']]
+                pinned[image] = '%s@%s' % (name, found['imageId']['imageDigest'])
+        return pinned
+
+
+def deployment_state(service):
+    # the parts of a service's deployments that change while it rolls out
+    return sorted((d['taskDefinition'], d['desiredCount'], d['runningCount'],
+                   d.get('pendingCount', 0)) for d in service.get('deployments', []))
+
+
+# release manifest keys of a service and the deploy options they set
+MANIFEST_KEYS = {
+    'cluster': 'cluster',
+    'service': 'service_name',
+    'taskDefinition': 'task_definition',
+    'image': 'image',
+    'desiredCount': 'desired_count',
+    'minimumHealthyPercent': 'min',
+    'maximumPercent': 'max',
+}
+
+
+def load_manifest(path):
+    """Read a release manifest from a JSON or (with PyYAML installed) YAML file.
+
+    A manifest lists services under ``services``, each with the keys of
+    MANIFEST_KEYS and an optional ``dependsOn`` list of service names; keys
+    under ``defaults`` apply to every service::
+
+        {"defaults": {"cluster": "production1", "minimumHealthyPercent": 50},
+         "services": [
+            {"service": "api", "image": "repo/api:2"},
+            {"service": "web", "image": "repo/web:2", "desiredCount": 4,
+             "dependsOn": ["api"]}]}
+    """
+    with open(path) as f:
+        if path.endswith(('.yml', '.yaml')):
+            try:
+                import yaml
+            except ImportError:
+                raise DeployError('PyYAML is required to read YAML manifests.')
+            return yaml.safe_load(f)
+        return json.load(f)
+
+
+def manifest_services(manifest):
+    # {service name: (deploy options, [dependency names])} in manifest order
+    defaults = manifest.get('defaults', {})
+    services = OrderedDict()
+    for entry in manifest.get('services', []):
+        entry = dict(defaults, **entry)
+        unknown = set(entry) - set(MANIFEST_KEYS) - set(['dependsOn'])
+        if unknown or not entry.get('service'):
+            raise DeployError('Invalid manifest entry %s' % json.dumps(entry, sort_keys=True))
+        options = dict((MANIFEST_KEYS[key], value) for key, value in entry.items()
+                       if key in MANIFEST_KEYS)
+        options['service_name'] = [entry['service']]
+        services[entry['service']] = (options, list(entry.get('dependsOn', [])))
+    return services
+
+
+def deploy_waves(dependencies):
+    """Group {service: [dependencies]} into waves of services that can deploy
+    concurrently once every earlier wave is healthy; raises DeployError for
+    unknown dependencies and cycles.
+    """
+    for name, depends_on in dependencies.items():
+        for dependency in depends_on:
+            if dependency not in dependencies:
+                raise DeployError('%s depends on unknown service %s' % (name, dependency))
+    waves = []
+    placed = set()
+    while len(placed) < len(dependencies):
+        wave = [name for name, depends_on in dependencies.items()
+                if name not in placed and placed.issuperset(depends_on)]
+        if not wave:
+            raise DeployError('Dependency cycle between %s' %
+                              ', '.join(sorted(set(dependencies) - placed)))
+        waves.append(wave)
+        placed.update(wave)
+    return waves
+
+
+def split_list(values):
+    # flatten repeated and comma separated argument values
+    return [value.strip() for item in values or [] for value in item.split(',')
+            if value.strip()]
+
+
+def image_list(images):
+    # the image option is a single image or a list of them
+    if not images:
+        return []
+    return list(images) if isinstance(images, (list, tuple)) else [images]
+
+
+def image_repository(image):
+    # repository of an image, without its tag or digest
+    name = image.split('@')[0]
+    if ':' in name.rsplit('/', 1)[-1]:
+        name = name.rsplit(':', 1)[0]
+    return name
+
+
+def container_index(task_definition):
+    # {repository: [positions of the containers running an image of it]}
+    index = {}
+    for position, container in enumerate(task_definition.get('containerDefinitions', [])):
+        index.setdefault(image_repository(container.get('image', '')), []).append(position)
+    return index
+
+
+def plan_diff(service, old_containers, new_containers, update):
+    # 'container.field: old -> new' for each container field a plan changes,
+    # then 'field: old -> new' for each service setting
+    lines = []
+    old = dict((c.get('name'), _normalize(c)) for c in old_containers)
+    for container in new_containers:
+        before, after = old.get(container.get('name'), {}), _normalize(container)
+        for key in sorted(set(before) | set(after)):
+            if before.get(key) != after.get(key):
+                lines.append('%s.%s: %s -> %s' % (container.get('name'), key,
+                                                  json.dumps(before.get(key), sort_keys=True),
+                                                  json.dumps(after.get(key), sort_keys=True)))
+    settings = dict(('deploymentConfiguration.%s' % key, value) for key, value in
+                    update.get('deploymentConfiguration', {}).items())
+    current = dict(('deploymentConfiguration.%s' % key, value) for key, value in
+                   service.get('deploymentConfiguration', {}).items())
+    if 'desiredCount' in update:
+        settings['desiredCount'] = update['desiredCount']
+        current['desiredCount'] = service.get('desiredCount')
+    for key in sorted(settings):
+        if settings[key] != current.get(key):
+            lines.append('%s: %s -> %s' % (key, current.get(key), settings[key]))
+    return lines
+
+
+def botocore_errors():
+    # botocore takes hundreds of milliseconds to import, so it is only loaded
+    # once an API call has been made and can have failed
+    from botocore.exceptions import BotoCoreError, ClientError
+    return BotoCoreError, ClientError
+
+
+def default_cache_dir():
+    return os.path.join(os.environ.get('XDG_CACHE_HOME') or
+                        os.path.join(os.path.expanduser('~'), '.cache'), 'ecs-deploy')
+
+
+def read_cache(path, ttl):
+    # cached JSON document at path, or None if it is missing, unreadable or
+    # older than ttl seconds
+    try:
+        if time.time() - os.path.getmtime(path) > ttl:
+            return None
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def write_cache(path, data):
+    # write through a temporary file so concurrent readers never see a
+    # partial document; caching is best effort
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        pass
+
+
+def task_definition_family(name):
+    # family of a task definition arn, family:revision or family name
+    return name.split('/')[-1].split(':')[0]
+
+
+def _normalize(value):
+    # drop the empty values ECS fills in when describing a task definition so
+    # that described and to-be-registered definitions compare equal
+    if isinstance(value, dict):
+        return dict((k, _normalize(v)) for k, v in value.items()
+                    if v is not None and v != [] and v != {} and v != '')
+    if isinstance(value, list):
+        return [_normalize(v) for v in value]
+    return value
+
+
+def task_definition_digest(definition):
+    # content address of the fields a registration would send
+    relevant = dict((field, definition.get(field)) for field in REGISTRATION_FIELDS)
+    encoded = json.dumps(_normalize(relevant), sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+def rollout_deployment(service, task_definition_arn):
+    for deployment in service.get('deployments', []):
+        if deployment['taskDefinition'] == task_definition_arn:
+            return deployment
+    return None
+
+
+def rollout_failed(service, task_definition_arn):
+    # set by the ECS deployment circuit breaker when it gives up on a rollout
+    deployment = rollout_deployment(service, task_definition_arn)
+    return bool(deployment and deployment.get('rolloutState') == 'FAILED')
+
+
+def placement_failure(event):
+    return 'unable to place a task' in event.get('message', '')
+
+
+def stopped_task_cause(task):
+    exit_codes = ', '.join('%s=%s' % (c['name'], c['exitCode']) for c in task.get('containers', [])
+                           if c.get('exitCode') is not None)
+    cause = 'task %s stopped: %s' % (task['taskArn'].split('/')[-1],
+                                     task.get('stoppedReason', 'unknown reason'))
+    if exit_codes:
+        cause += ' (exit codes: %s)' % exit_codes
+    return cause
+
+
+def rollout_complete(service, task_definition_arn):
+    # a rollout is complete once the deployment of the new revision has
+    # placed all of its desired tasks
+    deployment = rollout_deployment(service, task_definition_arn)
+    return bool(deployment and deployment['runningCount'] >= deployment['desiredCount'] and
+                not deployment.get('pendingCount'))
+
+
+def rollout_settled(service, task_definition_arn):
+    # the service runs only the revision, as its single PRIMARY deployment,
+    # and that rollout is complete: a deploy of it has nothing left to do
+    deployments = service.get('deployments', [])
+    return len(deployments) == 1 and deployments[0].get('status') == 'PRIMARY' and \
+        rollout_complete(service, task_definition_arn)
+
+
+def service_summary(service, latest_arn=None):
+    """Summarize a described service for the status command.
+
+    ``state`` is ``failed`` once the deployment circuit breaker has given up on
+    the primary deployment, ``stuck`` while a rollout has failed tasks or cannot
+    place them, ``rolling out``, ``degraded`` when fewer tasks run than desired,
+    or ``steady``. ``outdated`` is None unless the latest revision of the
+    service's family, ``latest_arn``, is known.
+    """
+    deployments = service.get('deployments', [])
+    primary = next((d for d in deployments if d.get('status') == 'PRIMARY'),
+                   deployments[0] if deployments else {})
+    events = service.get('events', [])
+    event = events[0] if events else {}
+    if service.get('status', 'ACTIVE') != 'ACTIVE':
+        state = service['status'].lower()
+    elif primary.get('rolloutState') == 'FAILED':
+        state = 'failed'
+    elif len(deployments) > 1 or primary.get('rolloutState') == 'IN_PROGRESS':
+        stuck = primary.get('failedTasks') or placement_failure(event)
+        state = 'stuck' if stuck else 'rolling out'
+    elif service.get('runningCount', 0) < service.get('desiredCount', 0):
+        state = 'degraded'
+    else:
+        state = 'steady'
+    return {
+        'service': service['serviceName'],
+        'state': state,
+        'task_definition': service.get('taskDefinition'),
+        'revision': (service.get('taskDefinition') or '').split('/')[-1],
+        'latest_revision': latest_arn.split('/')[-1] if latest_arn else None,
+        'outdated': service.get('taskDefinition') != latest_arn if latest_arn else None,
+        'desired': service.get('desiredCount', 0),
+        'running': service.get('runningCount', 0),
+        'pending': service.get('pendingCount', 0),
+        'deployments': len(deployments),
+        'event': event.get('message'),
+        'event_at': event.get('createdAt'),
+    }
+
+
+def format_status(summaries):
+    # a table of service summaries, one row per service
+    rows = [('SERVICE', 'STATE', 'REVISION', 'RUNNING', 'DEPLOYMENTS', 'LATEST EVENT')]
+    for summary in summaries:
+        revision = summary['revision']
+        if summary['outdated']:
+            revision += ' (latest %s)' % summary['latest_revision'].split(':')[-1]
+        rows.append((summary['service'], summary['state'], revision,
+                     '%(running)d/%(desired)d' % summary, str(summary['deployments']),
+                     summary['event'] or ''))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]) - 1)]
+    return '\n'.join('  '.join([value.ljust(width) for value, width in zip(row, widths)] +
+                               [row[-1]]).rstrip() for row in rows)
+
+
+class DeployError(Exception):
+    """Base class for errors raised while deploying."""
+
+
+class ClientCallError(DeployError):
+    """An ECS API call failed."""
+
+    def __init__(self, fn, error):
+        super(ClientCallError, self).__init__('%s failed: %s' % (fn, error))
+        self.fn = fn
+        self.error = error
+
+
+class DeployResult(namedtuple('DeployResult',
+                              'service task_definition_arn status elapsed cause')):
+    """Outcome of deploying one service.
+
+    ``status`` is one of ``deployed``, ``unchanged``, ``rolled_back``, ``failed``,
+    ``timeout`` or ``skipped`` (a dependency failed); ``cause`` describes why a
+    deploy failed.
+    """
+
+    @property
+    def ok(self):
+        return self.status in ('deployed', 'unchanged', 'rolled_back')
+
+
+class Deployer(object):
+    """Deploys images to ECS services.
+
+    Options are the long names of the command line arguments, e.g.
+    ``Deployer(cluster='production', service_name=['web'], image='repo/web:2')``.
+    ``image`` may also be a list of images, each set on the containers running
+    its repository.
+    An ECS ``client``, or a boto3 ``session`` to build one from, may be
+    injected so that many deploys in one process share warm connections.
+    Methods return :class:`DeployResult` objects and raise :class:`DeployError`.
+    ``on_event(service_name, event)`` is called with each new service event
+    while rollouts are watched. With the ``record`` option every ECS call is
+    written to a :class:`Cassette`, which a :class:`ReplayClient` can serve
+    back offline.
+    """
+    poll_scheduler = PollScheduler
+    metrics = None
+    rate_limiter = None
+    on_event = None
+    journal_id = None
+    current_service = None
+    cluster_capacity = None
+    capacity_warning = None
+    image_resolver = None
+    repository_index = None
+    planned = None
+    cassette = None
+    watcher = None
+    phase = None
+
+    def __init__(self, client=None, session=None, metrics=None, rate_limiter=None,
+                 on_event=None, image_resolver=None, cassette=None, **options):
+        self.args = options
+        self.on_event = on_event
+        self.cassette = cassette or (Cassette(options['record']) if options.get('record')
+                                     else None)
+        self.cluster = options.get('cluster')
+        self.session = session
+        self.client = client
+        self.metrics = metrics or Metrics()
+        self.rate_limiter = rate_limiter or RateLimiter(
+            options.get('read_rate') or DEFAULT_READ_RATE,
+            options.get('write_rate') or DEFAULT_WRITE_RATE)
+        self.ecr_clients = {}
+        self.ecr_lock = threading.Lock()
+        self.image_resolver = image_resolver
+        if image_resolver is None and options.get('pin_digests'):
+            ttl = options.get('digest_cache_ttl')
+            self.image_resolver = ImageResolver(
+                self._ecr_call, self._cache_path('image-digests.json'),
+                DEFAULT_DIGEST_CACHE_TTL if ttl is None else ttl)
+
+    @property
+    def client(self):
+        # built on first use, so that nothing pays for boto3 until a remote
+        # call is actually needed
+        if getattr(self, '_client', None) is None:
+            self._client = self._create_client(getattr(self, 'session', None))
+        return self._client
+
+    @client.setter
+    def client(self, client):
+        self._client = client
+
+    def _create_client(self, session=None, service='ecs', region=None):
+        # building clients from several threads at once is not safe, and the
+        # image resolver, region fan-out and daemon jobs all build them from
+        # threads, so every client is built under client_lock
+        with client_lock:
+            import boto3
+            from botocore.config import Config
+
+            if session is None:
+                # optional aws credentials overrides
+                credentials = {}
+                credentials = self._arg_kwargs(credentials, 'aws_access_key', 'aws_access_key_id')
+                credentials = self._arg_kwargs(credentials, 'aws_secret_key',
+                                               'aws_secret_access_key')
+                credentials = self._arg_kwargs(credentials, 'region', 'region_name')
+                credentials = self._arg_kwargs(credentials, 'profile', 'profile_name')
+                session = boto3.session.Session(**credentials)
+                if self.args.get('credential_cache'):
+                    self._cache_credentials(session)
+
+            # size the connection pool so that every worker can hold a connection
+            workers = self.args.get('workers') or DEFAULT_WORKERS
+            config = Config(max_pool_connections=max(workers, DEFAULT_WORKERS))
+            try:
+                return session.client(service, region_name=region or self.args.get('region'),
+                                      config=config)
+            except botocore_errors() as e:
+                raise DeployError('Failed to create boto3 client.\n%s' % e)
+
+    def _cache_credentials(self, session):
+        # give botocore's assume-role provider a cache shared between runs,
+        # keyed by profile and by botocore's hash of the role's settings
+        path = self._cache_path('credentials')
+        if path and not os.path.isdir(path):
+            try:
+                os.makedirs(path, 0o700)
+            except OSError:
+                path = None
+        if not path:
+            return
+        margin = self.args.get('credential_refresh_margin')
+        provider = session._session.get_component('credential_provider').get_provider(
+            'assume-role')
+        provider.cache = CredentialCache(
+            path, '%s--' % (self.args.get('profile') or 'default'),
+            DEFAULT_CREDENTIAL_REFRESH_MARGIN if margin is None else margin)
+
+    def _ecr_call(self, region, fn, **kwargs):
+        # ECR calls for the image resolver, with a client per registry region
+        # shared by the resolver's threads
+        with self.ecr_lock:
+            if region not in self.ecr_clients:
+                self.ecr_clients[region] = self._create_client(getattr(self, 'session', None),
+                                                               'ecr', region)
+            client = self.ecr_clients[region]
+        return self._call(fn, kwargs, client)
+
+    def _pin_images(self, images):
+        # resolve every image of the run up front, in one batch
+        images = [image for image in images if image]
+        if self.image_resolver and images:
+            with self._phase('resolve'):
+                self.image_resolver.resolve(images)
+
+    def _resolve_images(self, images):
+        # {image: the image to run}, pinned to digests with an image resolver
+        if self.image_resolver:
+            return self.image_resolver.resolve(images)
+        return dict((image, image) for image in images)
+
+    def _container_index(self):
+        # container_index of the task definition, built once per revision
+        arn = self.task_definition.get('taskDefinitionArn')
+        if self.repository_index is None or self.repository_index[0] != arn:
+            self.repository_index = (arn, container_index(self.task_definition))
+        return self.repository_index[1]
+
+    def _update_images(self, containers):
+        # set every image on the containers running its repository, so that
+        # all of them land in a single revision
+        images = image_list(self.args.get('image'))
+        resolved = self._resolve_images(images)
+        index = self._container_index()
+        repositories = [image_repository(image) for image in images]
+        if len(images) == 1 and repositories[0] not in index:
+            # a lone image replaces the first container's, whatever its repository
+            containers[0]['image'] = resolved[images[0]]
+            return
+        unmatched = [repository for repository in repositories if repository not in index]
+        if unmatched or len(set(repositories)) < len(repositories):
+            raise DeployError('Expected one image per container repository of %s, got %s.' %
+                              (self.task_definition['family'], ', '.join(images)))
+        for image, repository in zip(images, repositories):
+            for position in index[repository]:
+                containers[position]['image'] = resolved[image]
+
+    def _services_arg(self):
+        services = self.args.get('service_name') or [None]
+        return list(services) if isinstance(services, (list, tuple)) else [services]
+
+    def deploy(self):
+        """Deploy the image to every service, returning a DeployResult for each."""
+        self.service_name = None
+        self.unchanged = False
+        self.rolling_out = False
+        self.cluster = self.args.get('cluster')
+        # shared by every service so that their rollouts are checked together
+        self.cluster_capacity = ClusterCapacity(self._free_capacity) \
+            if self.args.get('capacity_check') else None
+        self._pin_images(image_list(self.args.get('image')))
+        services = self._services_arg()
+        deployments = [self._deployment(service) for service in services]
+
+        # start services concurrently on a bounded pool sharing one client
+        start = time.time()
+        workers = max(1, min(self.args.get('workers') or DEFAULT_WORKERS, len(deployments)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            causes = list(executor.map(self._start_service, deployments))
+
+        # then watch every started rollout with shared describe_services polls
+        targets = dict((d.service_name, d.new_task_definition['taskDefinitionArn'])
+                       for d, cause in zip(deployments, causes)
+                       if cause is None and not d.unchanged)
+        with self._phase('wait'):
+            watch = (lambda targets: self.watcher.watch(self, targets)) if self.watcher \
+                else self._watch
+            finished, failed = watch(targets) if targets else ({}, {})
+
+        results = []
+        for service, deployment, cause in zip(services, deployments, causes):
+            if cause is not None:
+                results.append(DeployResult(service, None, 'failed', time.time() - start, cause))
+                continue
+            name = deployment.service_name
+            if deployment.unchanged:
+                status, elapsed = 'unchanged', 0.0
+            elif name in finished:
+                status, elapsed = 'deployed', finished[name] - start
+            else:
+                status = 'failed' if name in failed else 'timeout'
+                elapsed = time.time() - start
+            results.append(DeployResult(name, deployment.new_task_definition['taskDefinitionArn'],
+                                        status, elapsed,
+                                        failed.get(name) or deployment.capacity_warning))
+
+        journal = self.journal
+        for deployment, result in zip(deployments, results):
+            if journal and deployment.journal_id:
+                journal.record(deployment.journal_id, status=result.status, cause=result.cause)
+
+        if self.args.get('max_definitions') and all(result.ok for result in results):
+            results = self._collect_after_deploy(deployments, results)
+        return results
+
+    def _collect_after_deploy(self, deployments, results):
+        # the services are deployed by now, so a failed cleanup is only
+        # reported alongside their results
+        try:
+            with self._phase('gc'):
+                for family in sorted(set(d.task_definition['family'] for d in deployments)):
+                    self._collect_task_definitions(family)
+        except DeployError as e:
+            warning = 'Deregistering old revisions failed: %s' % e
+            return [result._replace(cause='; '.join(filter(None, [result.cause, warning])))
+                    for result in results]
+        return results
+
+    def collect_task_definitions(self):
+        """Deregister old revisions of each service's task definition family.
+
+        Returns {family: [revision arns]} of the revisions deregistered, or with
+        the dry_run option, of the revisions that would be.
+        """
+        with self._phase('gc'):
+            families = set(self._deployment(service)._task_definition_name()
+                           for service in self._services_arg())
+            return dict((family, self._collect_task_definitions(family))
+                        for family in sorted(families))
+
+    def rollback(self):
+        """Roll every service back to the revision it ran before its last deploy.
+
+        The previous revision is read from the journal, so each service takes
+        a single update_service call and nothing is described. Rollouts are
+        not watched. Returns a DeployResult for each service.
+        """
+        if not self.journal:
+            raise DeployError('Rolling back needs the deploy journal.')
+        self.cluster = self.args.get('cluster')
+        services = self._services_arg()
+        workers = max(1, min(self.args.get('workers') or DEFAULT_WORKERS, len(services)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(self._rollback_service, services))
+
+    def _rollback_service(self, service_name):
+        start = time.time()
+        journal = self.journal
+        deploy = journal.last_rollout(self._journal_target(service_name))
+        if not deploy or not deploy['old_arn']:
+            return DeployResult(service_name, None, 'failed', 0.0,
+                                'No deploy of %s to roll back in the journal.' % service_name)
+        deployment = self._deployment(service_name)
+        deployment.service_name = service_name
+        deployment.new_task_definition = {'taskDefinitionArn': deploy['old_arn'],
+                                          'family': task_definition_family(deploy['old_arn'])}
+        try:
+            with deployment._phase('update'):
+                deployment.client_fn('update_service', taskDefinition=deploy['old_arn'])
+        except DeployError as e:
+            return DeployResult(service_name, None, 'failed', time.time() - start, str(e))
+        journal.record(deploy['id'], status='rolled_back')
+        return DeployResult(service_name, deploy['old_arn'], 'rolled_back',
+                            time.time() - start, None)
+
+    def plan(self):
+        """Work out, with read-only calls only, what deploying would change.
+
+        Services are described in batches, and each task definition family
+        once. Returns a plan: the region and cluster, and per service the
+        revision it runs, the containerDefinitions a new revision would have,
+        the update_service settings and a diff. apply() deploys a plan.
+        """
+        self.cluster = self.args.get('cluster')
+        self._pin_images(image_list(self.args.get('image')))
+        deployments = [self._deployment(service) for service in self._services_arg()]
+        with self._phase('resolve'):
+            for deployment in deployments:
+                deployment.cluster = self.cluster
+                deployment.service_name = deployment._service_name()
+        with self._phase('describe'):
+            names = [deployment.service_name for deployment in deployments]
+            services = dict((service['serviceName'], service) for service in self._describe_pages(
+                [names], 'describe_services', 'services', MAX_DESCRIBE_SERVICES))
+            missing = [name for name in names if name not in services]
+            if missing:
+                raise DeployError('Services not found: %s.' % ', '.join(missing))
+            # a deploy starts from the latest revision of the family
+            family_of = dict((name, task_definition_family(
+                self.args.get('task_definition') or services[name]['taskDefinition']))
+                for name in names)
+            families = sorted(set(family_of.values()))
+            workers = self.args.get('workers') or DEFAULT_WORKERS
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                described = executor.map(
+                    lambda family: self.client_fn('describe_task_definition',
+                                                  taskDefinition=family), families)
+                task_definitions = dict((family, response['taskDefinition'])
+                                        for family, response in zip(families, described))
+        return {
+            'version': PLAN_VERSION,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'region': self.client.meta.region_name,
+            'cluster': self.cluster,
+            'services': [deployment._plan_service(services[deployment.service_name],
+                                                  task_definitions[family_of[
+                                                      deployment.service_name]])
+                         for deployment in deployments],
+        }
+
+    def apply(self, plan):
+        """Deploy a plan made by plan(), returning a DeployResult per service.
+
+        Nothing is described again but the services, in batches, to check that
+        each still runs the revision the plan recorded; if any does not, a
+        DeployError is raised before anything changes. New revisions are
+        registered from the plan's containerDefinitions and rolled out with
+        its update_service settings, then watched as deploy() does.
+        """
+        if plan.get('version') != PLAN_VERSION:
+            raise DeployError('Unsupported plan version %s.' % plan.get('version'))
+        if plan.get('region') and plan['region'] != self.client.meta.region_name:
+            raise DeployError('The plan is for region %s.' % plan['region'])
+        names = [entry['service'] for entry in plan['services']]
+        applier = self._deployment(names)
+        applier.args.update(cluster=plan['cluster'], image=None, task_definition=None)
+        applier.cluster = plan['cluster']
+        with applier._phase('describe'):
+            running = dict((service['serviceName'], service['taskDefinition'])
+                           for service in applier._describe_pages(
+                               [names], 'describe_services', 'services', MAX_DESCRIBE_SERVICES))
+        changed = [entry['service'] for entry in plan['services']
+                   if running.get(entry['service']) != entry['current_service']['taskDefinition']]
+        if changed:
+            raise DeployError('Services changed since the plan was made: %s.' %
+                              ', '.join(changed))
+        applier.planned = dict((entry['service'], entry) for entry in plan['services'])
+        return applier.deploy()
+
+    def status(self):
+        """Summarize every service in the cluster, or the service_name services.
+
+        Services are described in concurrent batches. With the latest_revisions
+        option, the latest revision of each task definition family is described
+        too (one call per family) to flag services running an older one.
+        Returns a list of service_summary dicts, sorted by service name.
+        """
+        self.cluster = self.args.get('cluster')
+        names = self.args.get('service_name')
+        with self._phase('describe'):
+            pages = [names] if names else self._pages('list_services', 'serviceArns')
+            services = sorted(self._describe_pages(pages, 'describe_services', 'services',
+                                                   MAX_DESCRIBE_SERVICES),
+                              key=lambda service: service['serviceName'])
+            latest = {}
+            if self.args.get('latest_revisions'):
+                families = sorted(set(task_definition_family(service['taskDefinition'])
+                                      for service in services))
+                workers = self.args.get('workers') or DEFAULT_WORKERS
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    described = executor.map(
+                        lambda family: self.client_fn('describe_task_definition',
+                                                      taskDefinition=family), families)
+                    latest = dict((family, response['taskDefinition']['taskDefinitionArn'])
+                                  for family, response in zip(families, described))
+        return [service_summary(service,
+                                latest.get(task_definition_family(service['taskDefinition'])))
+                for service in services]
+
+    def deploy_manifest(self, manifest):
+        """Deploy every service of a release manifest (see load_manifest).
+
+        A service starts as soon as all of the services it depends on have
+        deployed; services whose dependencies failed are skipped. Options of
+        this Deployer, its client, metrics and rate limiter are shared by all
+        services. Returns a DeployResult per service, in manifest order.
+        """
+        services = manifest_services(manifest)
+        self._pin_images([image for options, _ in services.values()
+                          for image in image_list(options.get('image', self.args.get('image')))])
+        order = [name for wave in deploy_waves(
+            OrderedDict((name, deps) for name, (_, deps) in services.items())) for name in wave]
+
+        results = {}
+        running = {}
+
+        def submit_ready():
+            # in dependency order, so that skips cascade in a single pass
+            for name in order:
+                options, depends_on = services[name]
+                if name in results or name in running.values() or \
+                        not all(dep in results for dep in depends_on):
+                    continue
+                failed = [dep for dep in depends_on if not results[dep].ok]
+                if failed:
+                    results[name] = DeployResult(name, None, 'skipped', 0.0,
+                                                 'dependency %s failed' % ', '.join(failed))
+                else:
+                    running[executor.submit(self._deploy_options, options)] = name
+
+        workers = self.args.get('workers') or DEFAULT_WORKERS
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            submit_ready()
+            while running:
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    results[running.pop(future)] = future.result()
+                submit_ready()
+        return [results[name] for name in services]
+
+    def deploy_regions(self, regions, clusters, canary_region=None, manifest=None):
+        """Run the deploy (or the manifest's) in every cluster of every region.
+
+        Each region gets its own client and rate limiter, shared by the region's
+        clusters, and every region and cluster deploys concurrently. With
+        ``canary_region``, its clusters deploy first and the other regions are
+        skipped unless all of them succeed. A manifest deployed to several
+        clusters must not set a cluster of its own.
+
+        Returns {(region, cluster): [DeployResult]} in region, cluster order.
+        """
+        if manifest and len(clusters) > 1 and any(
+                'cluster' in options for options, _ in manifest_services(manifest).values()):
+            raise DeployError('A manifest that sets a cluster cannot be deployed to '
+                              'several clusters.')
+        deployers = self._region_deployers(regions, clusters)
+        targets = list(deployers)
+        canaries = [target for target in targets if target[0] == canary_region]
+        results = OrderedDict((target, None) for target in targets)
+        for wave in [canaries, [target for target in targets if target not in canaries]]:
+            with ThreadPoolExecutor(max_workers=max(1, len(wave))) as executor:
+                deploys = executor.map(lambda target: self._deploy_target(deployers[target],
+                                                                          manifest), wave)
+                results.update(zip(wave, deploys))
+            if not all(result.ok for target in wave for result in results[target]):
+                break
+        for target in targets:
+            if results[target] is None:
+                results[target] = [
+                    DeployResult(service, None, 'skipped', 0.0,
+                                 'canary region %s failed' % canary_region)
+                    for service in self._services_arg()]
+        return results
+
+    def _region_deployers(self, regions, clusters):
+        # one client and rate limiter per region, shared by its clusters
+        deployers = OrderedDict()
+        for region in regions:
+            deployer = Deployer(session=self.session, metrics=self.metrics,
+                                image_resolver=self.image_resolver, cassette=self.cassette,
+                                **dict(self.args, region=region))
+            for cluster in clusters:
+                deployers[region, cluster] = Deployer(
+                    client=deployer.client, metrics=self.metrics,
+                    rate_limiter=deployer.rate_limiter, on_event=self.on_event,
+                    image_resolver=self.image_resolver, cassette=self.cassette,
+                    **dict(self.args, region=region, cluster=cluster,
+                           region_clusters=list(clusters)))
+        return deployers
+
+    def _deploy_target(self, deployer, manifest=None):
+        try:
+            return deployer.deploy_manifest(manifest) if manifest else deployer.deploy()
+        except DeployError as e:
+            return [DeployResult(service, None, 'failed', 0.0, str(e))
+                    for service in self._services_arg()]
+
+    def _deploy_options(self, options):
+        # deploy a single service with options overriding this Deployer's
+        args = dict(self.args, task_definition=None)
+        args.update(options)
+        deployer = Deployer(client=self.client, metrics=self.metrics,
+                            rate_limiter=self.rate_limiter, on_event=self.on_event,
+                            image_resolver=self.image_resolver, cassette=self.cassette, **args)
+        name = options['service_name'][0]
+        try:
+            return deployer.deploy()[0]
+        except DeployError as e:
+            return DeployResult(name, None, 'failed', 0.0, str(e))
+
+    def _deployment(self, service_name):
+        # shallow copy sharing the client, with args scoped to a single service
+        deployment = copy.copy(self)
+        deployment.client = self.client
+        deployment.args = dict(self.args, service_name=service_name)
+        return deployment
+
+    @staticmethod
+    def _start_service(deployment):
+        # None once the service is started, otherwise the cause of failure;
+        # any error fails only this service, so that the others are still
+        # watched, reported and journaled
+        try:
+            return None if deployment._start() else 'update_service failed'
+        except DeployError as e:
+            return str(e)
+        except Exception as e:
+            return '%s: %s' % (type(e).__name__, e)
+
+    def _start(self):
+        self.cluster = self.args.get('cluster')
+        self.unchanged = False
+        self.rolling_out = False
+        self.current_service = None
+        planned = self.planned[self.args['service_name']] if self.planned else None
+        if planned:
+            phase = None
+        else:
+            with self._phase('resolve'):
+                self.task_definition_name = self._task_definition_name()
+                self.service_name = self._service_name()
+            phase = self._resume()
+        if phase is None:
+            if not (self._register_planned(planned) if planned else self._register()):
+                return False
+            if self.unchanged or self.rolling_out:
+                return True
+            self._journal_start()
+        elif phase == 'update':
+            # the service was updated before the deploy was interrupted
+            return True
+
+        with self._phase('preflight'):
+            self._check_capacity()
+        with self._phase('update'):
+            updated = bool(self.client_fn('update_service',
+                                          **(planned['update_service'] if planned else {})))
+        if updated and self.journal_id:
+            self.journal.record(self.journal_id, phase='update')
+        return updated
+
+    def _register(self):
+        with self._phase('describe'):
+            self.task_definition = self._describe_task_definition()
+        if not self.task_definition:
+            return False
+
+        with self._phase('register'):
+            digest = task_definition_digest(self.client_kwargs('register_task_definition'))
+            if not self.args.get('force') and \
+                    digest == task_definition_digest(self.task_definition):
+                # nothing would change: reuse the current revision, and skip
+                # the update if the service already runs it with the requested
+                # count and deployment configuration; the rollout is still
+                # watched unless it has settled, so retrying a failed deploy
+                # does not pass on an unfinished one
+                self.new_task_definition = self.task_definition
+                arn = self.task_definition['taskDefinitionArn']
+                service = self._current_service()
+                if service.get('taskDefinition') == arn and not plan_diff(
+                        service, [], [], self.client_kwargs('update_service')):
+                    self.unchanged = rollout_settled(service, arn)
+                    self.rolling_out = not self.unchanged
+            else:
+                self.new_task_definition = \
+                    self.client_fn('register_task_definition')['taskDefinition']
+                if self.task_definition_cache and \
+                        self.new_task_definition.get('taskDefinitionArn'):
+                    self.task_definition_cache.put(self.new_task_definition)
+        return True
+
+    def _register_planned(self, planned):
+        # _register from a plan's service entry, without describing anything
+        self.service_name = planned['service']
+        self.task_definition_name = planned['family']
+        self.current_service = planned['current_service']
+        self.task_definition = {'taskDefinitionArn': planned['task_definition'],
+                                'family': planned['family'],
+                                'containerDefinitions': planned['containerDefinitions']}
+        if planned['action'] != 'register':
+            self.new_task_definition = self.task_definition
+            self.unchanged = planned['action'] == 'none'
+            self.rolling_out = planned['action'] == 'watch'
+            return True
+        with self._phase('register'):
+            self.new_task_definition = \
+                self.client_fn('register_task_definition')['taskDefinition']
+        if self.task_definition_cache and self.new_task_definition.get('taskDefinitionArn'):
+            self.task_definition_cache.put(self.new_task_definition)
+        return True
+
+    def _plan_service(self, service, task_definition):
+        # the plan entry of this deployment's service, given its description
+        # and the task definition a deploy would start from
+        self.current_service = service
+        self.task_definition = task_definition
+        self.new_task_definition = {'family': task_definition['family']}
+        containers = self.client_kwargs('register_task_definition')['containerDefinitions']
+        update = self.client_kwargs('update_service')
+        for key in ('cluster', 'service', 'taskDefinition'):
+            update.pop(key, None)
+        diff = plan_diff(service, task_definition['containerDefinitions'], containers, update)
+        if self.args.get('force') or task_definition_digest(
+                {'family': task_definition['family'], 'containerDefinitions': containers}) != \
+                task_definition_digest(task_definition):
+            action = 'register'
+        elif service['taskDefinition'] == task_definition['taskDefinitionArn'] and not diff:
+            action = 'none' if rollout_settled(service, service['taskDefinition']) else 'watch'
+        else:
+            action = 'update'
+        return {
+            'service': service['serviceName'],
+            'family': task_definition['family'],
+            'current_service': dict((key, service[key]) for key in PLAN_SERVICE_KEYS
+                                    if key in service),
+            'task_definition': task_definition['taskDefinitionArn'],
+            'action': action,
+            'containerDefinitions': containers,
+            'update_service': update,
+            'diff': diff,
+        }
+
+    def _resume(self):
+        # the last phase finished by an interrupted deploy of the same image to
+        # this service, picked up from the journal, or None to deploy afresh
+        journal = self.journal
+        deploy = journal and journal.interrupted(self._journal_target(), self._journal_image())
+        if not deploy:
+            return None
+        self.journal_id = deploy['id']
+        arn = deploy['new_arn']
+        cache = self.task_definition_cache
+        self.task_definition = self.new_task_definition = (cache and cache.get(arn)) or \
+            {'taskDefinitionArn': arn, 'family': task_definition_family(arn)}
+        return deploy['phase']
+
+    def _journal_start(self):
+        journal = self.journal
+        if not journal:
+            return
+        with self._phase('describe'):
+            old_arn = self._service_task_definition()
+        self.journal_id = journal.start(self._journal_target(), self._journal_image(), old_arn,
+                                        self.new_task_definition['taskDefinitionArn'])
+
+    def _journal_image(self):
+        return ' '.join(image_list(self.args.get('image')))
+
+    def _journal_target(self, service_name=None):
+        # keyed on the region the client actually calls, which may come from
+        # the environment or the profile rather than --region
+        return (self.client.meta.region_name or '', self.cluster or 'default',
+                service_name or self.service_name)
+
+    @contextmanager
+    def _phase(self, name):
+        # attribute API calls made inside the block to the named deploy phase
+        # and record how long the phase took
+        previous, self.phase = self.phase, name
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.phase = previous
+            if self.metrics:
+                self.metrics.record_phase(name, getattr(self, 'service_name', None),
+                                          monotonic() - start)
+
+    @property
+    def task_definition_cache(self):
+        size = self.args.get('task_definition_cache_size')
+        path = size and self._cache_path('task-definitions.sqlite')
+        return TaskDefinitionCache(path, size * 1024 * 1024) if path else None
+
+    @property
+    def journal(self):
+        path = self.args.get('journal') and self._cache_path('journal.sqlite')
+        return DeployJournal(path) if path else None
+
+    def _cache_path(self, name):
+        # path of a file in the cache directory, which is created if needed
+        cache_dir = self.args.get('cache_dir') or default_cache_dir()
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                return None
+        return os.path.join(cache_dir, name)
+
+    def _describe_task_definition(self):
+        # a family name resolves to its latest revision, which may change, but
+        # a revision arn always describes the same task definition
+        cache = self.task_definition_cache
+        cacheable = cache and self.task_definition_name.startswith('arn:')
+        task_definition = cacheable and cache.get(self.task_definition_name)
+        if not task_definition:
+            task_definition = self.client_fn('describe_task_definition')['taskDefinition']
+            if cacheable and task_definition:
+                cache.put(task_definition)
+        return task_definition
+
+    def _service_task_definition(self):
+        return self._current_service().get('taskDefinition')
+
+    def _current_service(self):
+        # the service as it was before the rollout, described at most once
+        if self.current_service is None:
+            services = self.client_fn('describe_services',
+                                      services=[self.service_name])['services']
+            self.current_service = services[0] if services else {}
+        return self.current_service
+
+    def _check_capacity(self):
+        # simulate placing the tasks the rollout needs on the cluster's free
+        # capacity, failing the deploy (or warning) if they do not fit
+        if not self.cluster_capacity or \
+                self.new_task_definition.get('requiresCompatibilities') == ['FARGATE']:
+            return
+        service = self._current_service()
+        if not service or service.get('launchType') == 'FARGATE':
+            return
+        count = rollout_placements(service, self.args.get('desired_count'), self.args.get('min'))
+        cpu, memory = task_reservation(self.new_task_definition)
+        placed = self.cluster_capacity.place(cpu, memory, count)
+        if placed is None or placed >= count:
+            return
+        message = 'Cluster %s has room for %d of the %d new tasks (%d CPU units, %d MiB ' \
+            'each) the rollout of %s needs.' % (self.cluster, placed, count, cpu, memory,
+                                                 self.service_name)
+        if self.args.get('capacity_check') == 'fail':
+            raise DeployError(message)
+        self.capacity_warning = message
+
+    def _free_capacity(self):
+        # [cpu, memory] left on each connected container instance, described
+        # in concurrent batches of MAX_DESCRIBE_CONTAINER_INSTANCES
+        workers = self.args.get('workers') or DEFAULT_WORKERS
+        batch = MAX_DESCRIBE_CONTAINER_INSTANCES
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(self.client_fn, 'describe_container_instances',
+                                       containerInstances=arns[i:i + batch])
+                       for arns in self._pages('list_container_instances', 'containerInstanceArns',
+                                               status='ACTIVE')
+                       for i in range(0, len(arns), batch)]
+            free = []
+            for future in futures:
+                for instance in future.result()['containerInstances']:
+                    if instance.get('agentConnected', True):
+                        remaining = dict((r['name'], r.get('integerValue', 0))
+                                         for r in instance['remainingResources'])
+                        free.append([remaining.get('CPU', 0), remaining.get('MEMORY', 0)])
+            return free
+
+    def _watch(self, targets):
+        # poll describe_services for {service: task definition arn} until each
+        # service's deployment of that revision is fully running or has failed
+        # failure_threshold times; returns the time at which each finished
+        # service completed and the cause for each failed service
+        finished = {}
+        failed = {}
+        pending = dict(targets)
+        causes = dict((name, []) for name in targets)
+        seen = dict((name, {'tasks': set(), 'failed_tasks': 0}) for name in targets)
+        followers = {}
+        scheduler = self.poll_scheduler(self.args.get('timeout') or DEFAULT_TIMEOUT)
+        previous = None
+        while pending:
+            state = []
+            for service in self._describe_services(sorted(pending)):
+                name = service['serviceName']
+                state.append(deployment_state(service))
+                if name not in pending:
+                    continue
+                status, cause = self._check_rollout(service, pending[name], followers,
+                                                    causes[name], seen[name])
+                if status == 'finished':
+                    finished[name] = time.time()
+                    del pending[name]
+                elif status == 'failed':
+                    failed[name] = cause
+                    del pending[name]
+            if not pending or scheduler.expired():
+                break
+            scheduler.wait(state != previous)
+            previous = state
+        return finished, failed
+
+    def _describe_services(self, names):
+        for i in range(0, len(names), MAX_DESCRIBE_SERVICES):
+            batch = names[i:i + MAX_DESCRIBE_SERVICES]
+            for service in self.client_fn('describe_services', services=batch)['services']:
+                yield service
+
+    def _check_rollout(self, service, task_definition_arn, followers, causes, seen):
+        # ('finished', None) or ('failed', cause) once the rollout of the
+        # revision is over, (None, None) while it goes on; causes and seen
+        # carry the rollout's failures from poll to poll
+        events = self._follow_events(followers, service, task_definition_arn)
+        if rollout_complete(service, task_definition_arn):
+            return 'finished', None
+        if rollout_failed(service, task_definition_arn):
+            deployment = rollout_deployment(service, task_definition_arn)
+            return 'failed', deployment.get('rolloutStateReason', 'rollout failed')
+        threshold = self.args.get('failure_threshold')
+        if threshold:
+            causes.extend(self._rollout_failures(service, task_definition_arn, seen, events))
+            if len(causes) >= threshold:
+                return 'failed', causes[-1]
+        return None, None
+
+    def _follow_events(self, followers, service, task_definition_arn):
+        # new events of the service since its rollout started, passed on to
+        # the on_event callback as they arrive
+        name = service['serviceName']
+        if name not in followers:
+            deployment = rollout_deployment(service, task_definition_arn) or {}
+            followers[name] = EventFollower(deployment.get('createdAt'))
+        events = list(followers[name].follow(service))
+        if self.on_event:
+            for event in events:
+                self.on_event(name, event)
+        return events
+
+    def _rollout_failures(self, service, task_definition_arn, seen, events):
+        # new causes of failure for a rollout: stopped tasks of the new revision
+        # and placement failures among the service's new events; seen holds
+        # the stopped tasks already reported and the last failedTasks count
+        deployment = rollout_deployment(service, task_definition_arn)
+        if deployment is None:
+            return []
+
+        causes = []
+        # stopped tasks are only listed when failedTasks goes up, so polls cost
+        # the same however many tasks the service runs; it is only missing
+        # from older APIs, where every poll must look
+        failed_tasks = deployment.get('failedTasks')
+        if failed_tasks is None or failed_tasks > seen['failed_tasks']:
+            seen['failed_tasks'] = failed_tasks or 0
+            for task in self._tasks(serviceName=service['serviceName'], desiredStatus='STOPPED'):
+                if task['taskDefinitionArn'] == task_definition_arn and \
+                        task['taskArn'] not in seen['tasks']:
+                    seen['tasks'].add(task['taskArn'])
+                    causes.append(stopped_task_cause(task))
+
+        causes.extend(event['message'] for event in events if placement_failure(event))
+        return causes
+
+    def _collect_task_definitions(self, family):
+        # deregister all but the newest max_definitions revisions of family,
+        # keeping any revision that a service in the cluster still uses
+        in_use = self._task_definitions_in_use()
+        revisions = []
+        token = None
+        while True:
+            page = self.client_fn('list_task_definitions', familyPrefix=family,
+                                  **({'nextToken': token} if token else {}))
+            # familyPrefix also matches longer family names
+            revisions.extend(arn for arn in page['taskDefinitionArns']
+                             if task_definition_family(arn) == family)
+            token = page.get('nextToken')
+            if not token:
+                break
+
+        stale = [arn for arn in revisions[self.args.get('max_definitions'):]
+                 if arn not in in_use]
+        if not self.args.get('dry_run'):
+            self._deregister_task_definitions(stale)
+        return stale
+
+    def _task_definitions_in_use(self):
+        # revisions run by the services of every cluster deployed to in the
+        # region, since task definition families are shared by its clusters,
+        # including those of deployments still draining, which rollback needs
+        in_use = set()
+        for cluster in self.args.get('region_clusters') or [self.cluster]:
+            scoped = copy.copy(self)
+            scoped.client = self.client
+            scoped.cluster = cluster
+            for service in scoped._services():
+                in_use.add(service['taskDefinition'])
+                in_use.update(deployment['taskDefinition']
+                              for deployment in service.get('deployments', []))
+        return in_use
+
+    def _deregister_task_definitions(self, arns):
+        # deregister concurrently, submitting at most deregister_rate per second
+        bucket = TokenBucket(self.args.get('deregister_rate') or DEFAULT_DEREGISTER_RATE, 1)
+        workers = self.args.get('workers') or DEFAULT_WORKERS
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = []
+            for arn in arns:
+                bucket.acquire()
+                futures.append(executor.submit(self.client_fn, 'deregister_task_definition',
+                                               taskDefinition=arn))
+            for future in futures:
+                future.result()
+
+    def _services(self):
+        # describe every service in the cluster, in concurrent batches
+        return self._describe_pages(self._pages('list_services', 'serviceArns'),
+                                    'describe_services', 'services', MAX_DESCRIBE_SERVICES)
+
+    def _task_arns(self, **filters):
+        # page through list_tasks, yielding one page of task arns at a time
+        return self._pages('list_tasks', 'taskArns', **filters)
+
+    def _pages(self, fn, key, **filters):
+        # page through a list call, yielding each non-empty page of arns
+        token = None
+        while True:
+            if token:
+                filters['nextToken'] = token
+            response = self.client_fn(fn, **filters)
+            if response[key]:
+                yield response[key]
+            token = response.get('nextToken')
+            if not token:
+                return
+
+    def _tasks(self, **filters):
+        return self._describe_pages(self._task_arns(**filters), 'describe_tasks', 'tasks',
+                                    MAX_DESCRIBE_TASKS)
+
+    def _describe_pages(self, pages, fn, key, size):
+        # describe pages of arns in concurrent batches of at most size, passed
+        # to fn as key, yielding what is described as each batch returns; only
+        # a bounded number of batches is ever in flight
+        workers = self.args.get('workers') or DEFAULT_WORKERS
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = set()
+            for arns in pages:
+                for i in range(0, len(arns), size):
+                    futures.add(executor.submit(self.client_fn, fn, **{key: arns[i:i + size]}))
+                    if len(futures) >= workers:
+                        done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            for item in future.result()[key]:
+                                yield item
+            for future in as_completed(futures):
+                for item in future.result()[key]:
+                    yield item
+
+    def _task_definition_name(self):
+        if self.args.get('task_definition'):
+            return self.args.get('task_definition')
+
+        # use 'service_name' with describe_services() to get task definition
+        response = self.client_fn('describe_services')
+        if not response['services']:
+            reasons = ', '.join(failure.get('reason', 'unknown')
+                                for failure in response.get('failures', []))
+            raise DeployError('Service %s not found in cluster %s (%s).' % (
+                self.args.get('service_name'), self.cluster, reasons or 'not returned'))
+        arn = response['services'][0]['taskDefinition']
+        return arn.split('/')[1].split(':')[0]
+
+    def _service_name(self):
+        if self.args.get('service_name'):
+            return self.args.get('service_name')
+
+        # use 'task_definition' with the service index to get service name
+        family = task_definition_family(self.args.get('task_definition'))
+        services = self._service_index().get(family)
+        if services is None:
+            # the cached index may predate the service
+            services = self._service_index(refresh=True).get(family, [])
+        if len(services) != 1:
+            raise DeployError('Expected one service using task definition %s, found %s.' %
+                              (family, ', '.join(services) or 'none'))
+        return services[0]
+
+    def _service_index(self, refresh=False):
+        # {task definition family: [service names]} for every service in the
+        # cluster, reused from the cache directory for service_index_ttl seconds
+        ttl = self.args.get('service_index_ttl')
+        key = hashlib.sha1(('%s/%s' % (self.client.meta.region_name, self.cluster))
+                           .encode('utf-8')).hexdigest()
+        path = os.path.join(self.args.get('cache_dir') or default_cache_dir(),
+                            'services-%s.json' % key)
+        index = None if refresh or not ttl else read_cache(path, ttl)
+        if index is None:
+            index = {}
+            for service in self._services():
+                family = task_definition_family(service['taskDefinition'])
+                index.setdefault(family, []).append(service['serviceName'])
+            if ttl:
+                write_cache(path, index)
+        return index
+
+    def _arg_kwargs(self, kwargs, arg_name, alt_name=None):
+        # add specified arg to kwargs if it exists, return kwargs
+        if self.args.get(arg_name):
+            kwarg_name = alt_name or arg_name
+            kwargs[kwarg_name] = self.args.get(arg_name)
+        return kwargs
+
+    def client_kwargs(self, fn, **overrides):
+        kwargs = dict(STATIC_KWARGS.get(fn, {}))
+
+        if fn in CLUSTER_SCOPED_CALLS:
+            kwargs['cluster'] = self.cluster
+
+        if fn == 'describe_services':
+            kwargs['services'] = [self.args.get('service_name')]
+
+        elif fn == 'describe_task_definition' and 'taskDefinition' not in overrides:
+            kwargs['taskDefinition'] = self.task_definition_name
+
+        elif fn == 'register_task_definition':
+            kwargs['family'] = self.task_definition['family']
+            kwargs['containerDefinitions'] = copy.deepcopy(
+                self.task_definition['containerDefinitions'])
+            # optional kwargs from args
+            if self.args.get('image'):
+                self._update_images(kwargs['containerDefinitions'])
+
+        elif fn == 'update_service':
+            kwargs['service'] = self.service_name
+            # the exact revision: a family name resolves to whichever revision
+            # was registered last, maybe by a concurrent deploy of the family
+            kwargs['taskDefinition'] = self.new_task_definition.get('taskDefinitionArn') or \
+                self.new_task_definition['family']
+            # optional kwargs from args
+            deployment_config = {}
+            deployment_config = self._arg_kwargs(deployment_config, 'min',
+                                                 'minimumHealthyPercent')
+            deployment_config = self._arg_kwargs(deployment_config, 'max',
+                                                 'maximumPercent')
+            kwargs['deploymentConfiguration'] = deployment_config
+            kwargs = self._arg_kwargs(kwargs, 'desired_count', 'desiredCount')
+
+        elif fn == 'list_tasks':
+            kwargs['serviceName'] = self.service_name
+            kwargs['desiredStatus'] = 'RUNNING'
+
+        elif fn == 'describe_tasks' and 'tasks' not in overrides:
+            kwargs['tasks'] = self.client_fn('list_tasks')['taskArns']
+
+        kwargs.update(overrides)
+        return kwargs
+
+    def client_fn(self, fn, **overrides):
+        kwargs = self.client_kwargs(fn, **overrides)
+        max_retries = self.args.get('max_retries')
+        if max_retries is None:
+            max_retries = DEFAULT_MAX_RETRIES
+        attempt = 0
+        while True:
+            if self.rate_limiter:
+                self.rate_limiter.acquire(fn)
+            try:
+                return self._call(fn, kwargs)
+            except ClientCallError as e:
+                if attempt >= max_retries or not retryable_error(e.error):
+                    raise
+                delay = retry_delay(attempt)
+                if self.metrics:
+                    code = (getattr(e.error, 'response', None) or {}).get('Error', {}).get('Code')
+                    self.metrics.record_retry(fn, code, delay)
+                time.sleep(delay)
+                attempt += 1
+
+    def _call(self, fn, kwargs, client=None):
+        response, error = None, None
+        start = monotonic()
+        try:
+            response = getattr(client or self.client, fn)(**kwargs)
+            return response
+
+        except botocore_errors() as e:
+            error = e
+            raise ClientCallError(fn, e)
+        finally:
+            if self.metrics:
+                self._record_call(fn, monotonic() - start, response, error)
+            if self.cassette and client is None:
+                self.cassette.record(fn, kwargs, response, error, monotonic() - start)
+
+    def _record_call(self, fn, latency, response, error):
+        source = response if error is None else getattr(error, 'response', None)
+        metadata = source.get('ResponseMetadata', {}) if isinstance(source, dict) else {}
+        size = metadata.get('HTTPHeaders', {}).get('content-length', 0)
+        self.metrics.record_call(fn, self.phase, getattr(self, 'service_name', None), latency,
+                                 metadata.get('RetryAttempts', 0), int(size),
+                                 error and error.__class__.__name__)
+
+
+class ClusterWatcher(object):
+    """Watches the rollouts of every deploy to one cluster with shared polls.
+
+    Deployers hand their started rollouts to :meth:`watch`, which blocks and
+    returns like :meth:`Deployer._watch`. A single thread describes all of the
+    cluster's pending services in batches, through ``deployer``, so concurrent
+    deploys share their describe_services polls.
+    """
+
+    def __init__(self, deployer):
+        self.deployer = deployer
+        self.rollouts = {}
+        self.lock = threading.Lock()
+        self.changed = threading.Event()
+        self.thread = None
+
+    def watch(self, deployer, targets):
+        timeout = deployer.args.get('timeout') or DEFAULT_TIMEOUT
+        rollouts = {}
+        with self.lock:
+            for name, arn in targets.items():
+                if name in self.rollouts:
+                    self._finish(self.rollouts[name], 'failed', 'superseded by a newer deploy')
+                rollouts[name] = self.rollouts[name] = {
+                    'name': name, 'deployer': deployer, 'arn': arn,
+                    'deadline': monotonic() + timeout, 'causes': [],
+                    'seen': {'tasks': set(), 'failed_tasks': 0},
+                    'followers': {}, 'status': None, 'cause': None, 'at': None,
+                    'done': threading.Event()}
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run)
+                self.thread.daemon = True
+                self.thread.start()
+        self.changed.set()
+        for rollout in rollouts.values():
+            rollout['done'].wait()
+        done = rollouts.values()
+        return (dict((r['name'], r['at']) for r in done if r['status'] == 'finished'),
+                dict((r['name'], r['cause']) for r in done if r['status'] == 'failed'))
+
+    def _run(self):
+        scheduler = self.deployer.poll_scheduler(float('inf'))
+        previous = None
+        while True:
+            with self.lock:
+                # cleared before the snapshot, so that a rollout watched after
+                # it still wakes the wait below
+                self.changed.clear()
+                pending = dict(self.rollouts)
+                if not pending:
+                    self.thread = None
+                    return
+            state = self._poll(pending)
+            with self.lock:
+                for rollout in pending.values():
+                    if rollout['status'] is None and monotonic() >= rollout['deadline']:
+                        self._finish(rollout, 'timeout', None)
+                deadlines = [r['deadline'] for r in self.rollouts.values()]
+            if deadlines:
+                # a newly watched rollout cuts the wait short
+                self.changed.wait(min(scheduler.next_delay(state != previous),
+                                      max(0.0, min(deadlines) - monotonic())))
+            previous = state
+
+    def _poll(self, pending):
+        state = []
+        try:
+            for service in self.deployer._describe_services(sorted(pending)):
+                state.append(deployment_state(service))
+                rollout = pending.get(service['serviceName'])
+                if rollout is None or rollout['status']:
+                    continue
+                status, cause = rollout['deployer']._check_rollout(
+                    service, rollout['arn'], rollout['followers'], rollout['causes'],
+                    rollout['seen'])
+                if status:
+                    with self.lock:
+                        self._finish(rollout, status, cause)
+        except Exception as e:
+            # fail rather than leave deployers waiting on a poll that never comes
+            with self.lock:
+                for rollout in pending.values():
+                    self._finish(rollout, 'failed', str(e))
+        return state
+
+    def _finish(self, rollout, status, cause):
+        if rollout['status']:
+            return
+        rollout['status'], rollout['cause'], rollout['at'] = status, cause, time.time()
+        if self.rollouts.get(rollout['name']) is rollout:
+            del self.rollouts[rollout['name']]
+        rollout['done'].set()
+
+
+class DeployJob(object):
+    """A deploy submitted to a :class:`DeployDaemon`.
+
+    ``status`` goes from ``queued`` to ``running`` to ``done``; ``results`` are
+    the deploy's DeployResults and ``error`` why it could not run at all.
+    """
+
+    def __init__(self, job_id, options):
+        self.id = job_id
+        self.options = options
+        self.status = 'queued'
+        self.submitted = time.time()
+        self.results = []
+        self.error = None
+        self.events = []
+        self.condition = threading.Condition()
+
+    @property
+    def ok(self):
+        return self.status == 'done' and not self.error and \
+            all(result.ok for result in self.results)
+
+    def start(self):
+        with self.condition:
+            self.status = 'running'
+            self.condition.notify_all()
+
+    def add_event(self, service_name, event):
+        with self.condition:
+            self.events.append((service_name, event))
+            self.condition.notify_all()
+
+    def finish(self, results, error=None):
+        with self.condition:
+            self.status = 'done'
+            self.results = results
+            self.error = error
+            self.condition.notify_all()
+
+    def follow(self):
+        # (service name, event) for each event of the deploy, as they arrive,
+        # until it is done
+        index = 0
+        while True:
+            with self.condition:
+                while index == len(self.events) and self.status != 'done':
+                    self.condition.wait(1.0)
+                events = self.events[index:]
+                index += len(events)
+                done = self.status == 'done' and index == len(self.events)
+            for event in events:
+                yield event
+            if done:
+                return
+
+    def to_dict(self):
+        return {'id': self.id, 'status': self.status, 'submitted': self.submitted,
+                'options': self.options, 'error': self.error, 'ok': self.ok,
+                'results': [dict(zip(result._fields, result)) for result in self.results]}
+
+
+# options a job submitted to the daemon may set
+JOB_OPTIONS = frozenset([
+    'service_name', 'task_definition', 'cluster', 'region', 'image', 'desired_count', 'min',
+    'max', 'timeout', 'failure_threshold', 'force', 'capacity_check'])
+
+
+class DeployDaemon(object):
+    """Runs deploys for the clients of a long running process.
+
+    Each region gets one warm Deployer, whose client and rate limiter every
+    job to the region shares; each job records its own metrics, and the
+    long-lived deployers record none, so that a daemon's memory does not grow
+    with every poll. At most ``cluster_concurrency`` jobs deploy
+    to a cluster at once, the others wait in line, and the rollouts of all of a
+    cluster's jobs are watched by one :class:`ClusterWatcher`. ``options`` are
+    the defaults of every job.
+    """
+
+    def __init__(self, session=None, cluster_concurrency=DEFAULT_CLUSTER_CONCURRENCY,
+                 **options):
+        self.session = session
+        self.cluster_concurrency = cluster_concurrency
+        self.args = options
+        self.jobs = OrderedDict()
+        self.regions = {}
+        self.watchers = {}
+        self.slots = {}
+        self.lock = threading.Lock()
+
+    def submit(self, options):
+        """Queue a deploy with options overriding the daemon's; returns its DeployJob."""
+        unknown = sorted(set(options) - JOB_OPTIONS)
+        if unknown:
+            raise DeployError('Unknown job options: %s.' % ', '.join(unknown))
+        if isinstance(options.get('service_name'), str):
+            options = dict(options, service_name=[options['service_name']])
+        args = dict(self.args, **options)
+        if not args.get('cluster') or not args.get('image') or \
+                not (args.get('service_name') or args.get('task_definition')):
+            raise DeployError('A job needs a cluster, an image and a service-name or '
+                              'task-definition.')
+        job = DeployJob('%012x' % random.getrandbits(48), options)
+        with self.lock:
+            self.jobs[job.id] = job
+            done = [j for j in self.jobs.values() if j.status == 'done']
+            for old in done[:max(0, len(self.jobs) - DEFAULT_JOB_HISTORY)]:
+                del self.jobs[old.id]
+        thread = threading.Thread(target=self._run, args=(job, args))
+        thread.daemon = True
+        thread.start()
+        return job
+
+    def job(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def _run(self, job, args):
+        region, cluster = args.get('region'), args.get('cluster')
+        try:
+            base = self._region(region)
+            with self._shared(self.slots, (region, cluster),
+                              lambda: threading.Semaphore(self.cluster_concurrency)):
+                job.start()
+                deployer = Deployer(client=base.client, rate_limiter=base.rate_limiter,
+                                    on_event=job.add_event, image_resolver=base.image_resolver,
+                                    cassette=base.cassette, **args)
+                deployer.watcher = self._shared(self.watchers, (region, cluster),
+                                                lambda: ClusterWatcher(self._unmetered(Deployer(
+                                                    client=base.client,
+                                                    rate_limiter=base.rate_limiter,
+                                                    **dict(args, cluster=cluster)))))
+                job.finish(deployer.deploy())
+        except DeployError as e:
+            job.finish([], str(e))
+        except Exception as e:
+            # a job must always finish, or its clients would wait forever
+            job.finish([], 'unexpected error: %r' % e)
+            raise
+
+    def _region(self, region):
+        # one deployer per region, with its client and rate limiter, shared
+        # by every job
+        with self.lock:
+            if region not in self.regions:
+                deployer = Deployer(session=self.session, **dict(self.args, region=region))
+                deployer.client
+                self.regions[region] = self._unmetered(deployer)
+            return self.regions[region]
+
+    @staticmethod
+    def _unmetered(deployer):
+        # deployers living as long as the daemon record no metrics, which
+        # would only ever grow
+        deployer.metrics = None
+        return deployer
+
+    def _shared(self, objects, key, create):
+        with self.lock:
+            if key not in objects:
+                objects[key] = create()
+            return objects[key]
+
+
+class DaemonRequestHandler(object):
+    """HTTP API of a DeployDaemon, mixed into BaseHTTPRequestHandler by :func:`serve`."""
+
+    def address_string(self):
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/jobs':
+            return self._send(404, {'error': 'not found'})
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            options = json.loads(self.rfile.read(length).decode('utf-8') or '{}')
+            job = self.server.deploy_daemon.submit(options)
+        except (ValueError, TypeError, AttributeError, DeployError) as e:
+            return self._send(400, {'error': str(e)})
+        self._send(202, job.to_dict())
+
+    def do_GET(self):
+        daemon = self.server.deploy_daemon
+        parts = self.path.strip('/').split('/')
+        job = daemon.job(parts[1]) if len(parts) > 1 and parts[0] == 'jobs' else None
+        if parts == ['jobs']:
+            with daemon.lock:
+                jobs = list(daemon.jobs.values())
+            self._send(200, [j.to_dict() for j in jobs])
+        elif job and len(parts) == 2:
+            self._send(200, job.to_dict())
+        elif job and parts[2:] == ['events']:
+            self._stream(job)
+        else:
+            self._send(404, {'error': 'not found'})
+
+    def _send(self, code, body):
+        data = json.dumps(body, sort_keys=True, default=str).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _stream(self, job):
+        # events as JSON lines while the job runs, then the finished job
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        for service_name, event in job.follow():
+            self.wfile.write((format_event(service_name, event, 'json') + '\n').encode('utf-8'))
+            self.wfile.flush()
+        self.wfile.write((json.dumps(job.to_dict(), sort_keys=True, default=str) + '\n')
+                         .encode('utf-8'))
+
+
+def daemon_server(daemon, address=None):
+    """HTTP server of a DeployDaemon on ``host:port`` or a Unix socket path.
+
+    ``POST /jobs`` submits a job from a JSON object of options and answers with
+    the job, ``GET /jobs/<id>`` returns a job, and ``GET /jobs/<id>/events``
+    streams its events as JSON lines, ending with the finished job.
+
+    There is no authentication: anyone who can connect deploys with the
+    daemon's credentials. The default address is a Unix socket in the cache
+    directory, and Unix sockets are only accessible to their owner (mode 0600);
+    a TCP port is open to every local user.
+    """
+    try:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        from socketserver import ThreadingMixIn, UnixStreamServer
+    except ImportError:
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        from SocketServer import ThreadingMixIn, UnixStreamServer
+
+    address = address or os.path.join(default_cache_dir(), DEFAULT_SOCKET)
+    umask = None
+    if ':' in address and not address.startswith(('/', '.')):
+        host, port = address.rsplit(':', 1)
+        server_class, server_address = HTTPServer, (host, int(port))
+    else:
+        if os.path.exists(address):
+            os.remove(address)
+        elif not os.path.isdir(os.path.dirname(address) or '.'):
+            os.makedirs(os.path.dirname(address))
+        server_class, server_address = UnixStreamServer, address
+        # the socket is created owner-only rather than chmod-ed after binding
+        umask = os.umask(0o177)
+
+    try:
+        server = type('DaemonServer', (ThreadingMixIn, server_class), {'daemon_threads': True})(
+            server_address, type('Handler', (DaemonRequestHandler, BaseHTTPRequestHandler), {}))
+    finally:
+        if umask is not None:
+            os.umask(umask)
+    server.deploy_daemon = daemon
+    return server
+
+
+class CLI(Deployer):
+    regions = ()
+    clusters = ()
 
-class CLI(object):
     def __init__(self):
         # get args
         self.args = self._init_parser()
 
-        # init boto3 client
-        try:
-            # optional aws credentials overrides
-            credentials = {}
-            credentials = self._arg_kwargs(credentials, 'aws_access_key', 'aws_access_key_id')
-            credentials = self._arg_kwargs(credentials, 'aws_secret_key', 'aws_secret_access_key')
-            credentials = self._arg_kwargs(credentials, 'aws_region', 'region')
-
-            # init boto3 ecs client
-            self.client = boto3.client('ecs', **credentials)
-        except ClientError as err:
-            print('Failed to create boto3 client.\n%s' % err)
+        # several regions and clusters fan out; the first is the default
+        self.regions = split_list(self.args.get('region'))
+        self.clusters = split_list(self.args.get('cluster'))
+        self.args['region'] = self.regions[0] if self.regions else None
+        self.args['cluster'] = self.clusters[0] if self.clusters else None
+
+        if self.args.get('canary_region') and \
+                self.args['canary_region'] not in self.regions:
+            print('canary-region must be one of the regions deployed to.')
+            sys.exit(1)
+
+        if self.args.get('command') in ('serve', 'apply'):
+            # jobs bring their own services, images and clusters, and a plan
+            # its own region, cluster and services
+            pass
+
+        elif self.args.get('manifest'):
+            if self.args.get('command') != 'deploy':
+                print('A manifest can only be deployed.')
+                sys.exit(1)
+
+        elif not self.args.get('cluster'):
+            print('cluster must be provided.')
             sys.exit(1)
 
-        if not (self.args.get('task_definition') or self.args.get('service_name')):
+        elif self.args.get('command') != 'status' and not (
+                self.args.get('task_definition') or self.args.get('service_name')):
             print('Either task-definition or service-name must be provided.')
             sys.exit(1)
 
-        # run script
-        self._run_parser()
+        elif self.args.get('command') in ('deploy', 'plan') and not self.args.get('image'):
+            print('image must be provided to deploy.')
+            sys.exit(1)
+
+        self._validate_command()
+
+        # run script; the boto3 client is only built once it is first used
+        super(CLI, self).__init__(
+            client=self._replay_client(),
+            on_event=self._print_event if self.args.get('verbose') else None, **self.args)
+        try:
+            sys.exit(self._run_parser())
+        except DeployError as e:
+            print(e)
+            sys.exit(1)
+        finally:
+            if self.args.get('metrics_out'):
+                self.metrics.write(self.args['metrics_out'], self.args.get('metrics_format'))
+
+    def _replay_client(self):
+        # serve ECS calls from a recorded cassette instead of AWS
+        if self.args.get('replay'):
+            return ReplayClient(self.args['replay'], self.args.get('replay_latency') or 0.0,
+                                self.args.get('region'))
+        return None
+
+    def _validate_command(self):
+        # options required by the gc, rollback, plan and apply commands
+        if self.args.get('command') == 'gc' and not self.args.get('max_definitions'):
+            print('max-definitions must be provided to collect task definitions.')
+            sys.exit(1)
+
+        if self.args.get('command') == 'gc' and (len(self.regions) > 1 or len(self.clusters) > 1):
+            print('A single region and cluster must be provided to collect task definitions.')
+            sys.exit(1)
+
+        if self.args.get('command') == 'rollback' and (
+                not self.args.get('service_name') or len(self.regions) > 1 or
+                len(self.clusters) > 1):
+            print('service-name and a single region and cluster must be provided to roll back.')
+            sys.exit(1)
+
+        if self.args.get('command') in ('plan', 'apply') and (
+                not self.args.get('plan_file') or len(self.regions) > 1 or
+                len(self.clusters) > 1):
+            print('plan-file and a single region and cluster must be provided to plan or apply.')
+            sys.exit(1)
 
     def _init_parser(self):
         parser = argparse.ArgumentParser(
-            description='AWS ECS Deployment Script', usage='ecs-deploy.py [<args>]')
+            description='AWS ECS Deployment Script', usage='ecs-deploy.py [<command>] [<args>]')
+
+        parser.add_argument(
+            'command',
+            nargs='?',
+            default='deploy',
+            choices=['deploy', 'gc', 'rollback', 'serve', 'status', 'plan', 'apply'],
+            help='deploy (default) rolls out a new image, gc only deregisters old task \
+                definition revisions, rollback returns services to the revision they ran \
+                before their last deploy, serve runs a daemon that deploys jobs submitted \
+                over HTTP, status summarizes every service in the cluster, plan writes what \
+                a deploy would change to a plan file with read-only calls, and apply deploys \
+                a plan file')
 
         parser.add_argument(
             '-n',
             '--service-name',
-            help='Name of service to deploy (either service-name or task-definition is required)')
+            action='append',
+            help='Name of service to deploy (either service-name or task-definition is required). \
+                May be repeated to deploy several services concurrently')
 
         parser.add_argument(
             '-d',
@@ -59,8 +2630,9 @@ class CLI(object):
         parser.add_argument(
             '-c',
             '--cluster',
-            required=True,
-            help='Name of ECS cluster')
+            action='append',
+            help='Name of ECS cluster (the default cluster of a manifest\'s services). \
+                Repeat, or separate with commas, to deploy to several clusters concurrently')
 
         parser.add_argument(
             '-k',
@@ -76,7 +2648,13 @@ class CLI(object):
         parser.add_argument(
             '-r',
             '--region',
-            help='AWS Region Name. May also be set as environment variable AWS_DEFAULT_REGION')
+            action='append',
+            help='AWS Region Name. May also be set as environment variable AWS_DEFAULT_REGION. \
+                Repeat, or separate with commas, to deploy to several regions concurrently')
+
+        parser.add_argument(
+            '--canary-region',
+            help='Deploy to this region first, and to the other regions only if it succeeds')
 
         # REQUIRED ARGS : MAYBE NOT REQUIRED
         parser.add_argument(
@@ -93,13 +2671,20 @@ class CLI(object):
         parser.add_argument(
             '-i',
             '--image',
-            required=True,
+            action='append',
             help='Name of Docker image to run, ex: repo/image:latest\nFormat: \
                 [domain][:port][/repo][/][image][:tag]\nExamples: mariadb, \
                 mariadb:latest, silintl/mariadb,\nsilintl/mariadb:latest, \
-                private.registry.com:8000/repo/image:tag')
+                private.registry.com:8000/repo/image:tag\nRepeat to update several \
+                containers in one revision; each image is set on the containers running \
+                its repository')
 
         # OPTIONAL ARGUMENTS
+        parser.add_argument(
+            '--manifest',
+            help='Release manifest (JSON, or YAML with PyYAML installed) listing the \
+                services, images, counts and dependencies to deploy.')
+
         parser.add_argument(
             '-D',
             '--desired-count',
@@ -124,7 +2709,9 @@ class CLI(object):
         parser.add_argument(
             '-t',
             '--timeout',
-            help='Default is 90s. Script monitors ECS Service for new task \
+            type=int,
+            default=DEFAULT_TIMEOUT,
+            help='Default is %(default)ss. Script monitors ECS Service for new task \
                 definition to be running.')
 
         parser.add_argument(
@@ -137,126 +2724,322 @@ class CLI(object):
             '-v',
             '--verbose',
             action='store_true',
-            help='Verbose output')
+            help='Verbose output: stream service events while waiting for rollouts')
 
         parser.add_argument(
-            '--max-definitions',
+            '--events-format',
+            choices=['text', 'json'],
+            default='text',
+            help='Default is %(default)s. Format of the events streamed by --verbose: \
+                readable lines or JSON lines.')
+
+        parser.add_argument(
+            '-w',
+            '--workers',
             type=int,
-            help='Number of Task Definition Revisions to persist before \
-                deregistering oldest revisions.')
+            default=DEFAULT_WORKERS,
+            help='Default is %(default)s. Maximum number of services deployed concurrently.')
 
-        args = parser.parse_args(sys.argv[1:])
-        return vars(args)
+        parser.add_argument(
+            '-f',
+            '--failure-threshold',
+            type=int,
+            default=DEFAULT_FAILURE_THRESHOLD,
+            help='Default is %(default)s. Abort once this many tasks of the new task \
+                definition have stopped or failed to be placed (0 to wait for the timeout).')
 
-    def _run_parser(self):
-        self.cluster = self.args.get('cluster')
-        self.task_definition_name = self._task_definition_name()
-        self.service_name = self._service_name()
+        parser.add_argument(
+            '--cache-dir',
+            default=default_cache_dir(),
+            help='Default is %(default)s. Directory for local caches of ECS lookups.')
 
-        self.task_definition = self.client_fn('describe_task_definition')['taskDefinition']
-        self.new_task_definition = self.client_fn('register_task_definition')['taskDefinition']
+        parser.add_argument(
+            '--no-journal',
+            dest='journal',
+            action='store_false',
+            help='Do not record deploys in the journal in the cache directory, which \
+                resumes interrupted deploys and is needed to roll back.')
 
-        if self.task_definition:
-            if not self.client_fn('update_service'):
-                sys.exit(1)
+        parser.add_argument(
+            '--service-index-ttl',
+            type=int,
+            default=DEFAULT_SERVICE_INDEX_TTL,
+            help='Default is %(default)ss. How long the index of services by task \
+                definition family may be reused across runs (0 disables caching).')
 
-            # loop for desired timeout
-            timeout = self.args.get('timeout') or time.time() + 90
-            while True:
-                updated = False
-                running_tasks = self.client_fn('describe_tasks')['tasks']
-                for task in running_tasks:
-                    if task['taskDefinitionArn'] == self.new_task_definition['taskDefinitionArn']:
-                        updated = True
-                if updated or time.time() > timeout:
-                    sys.exit(0)
-                time.sleep(1)
+        parser.add_argument(
+            '--task-definition-cache-size',
+            type=int,
+            default=DEFAULT_TASK_DEFINITION_CACHE_SIZE,
+            help='Default is %(default)sMB. Size of the local cache of task definition \
+                revisions (0 disables caching). Only revision ARNs are cached, which saves the \
+                describes of -d <revision ARN> and of resumed deploys; a family name, as \
+                resolved from -n or given to -d, always goes to the API for its latest \
+                revision.')
 
-        else:
-            sys.exit(1)
+        parser.add_argument(
+            '--read-rate',
+            type=float,
+            default=DEFAULT_READ_RATE,
+            help='Default is %(default)s. Maximum describe and list calls per second, \
+                shared by every concurrent deploy.')
 
-    def _task_definition_name(self):
-        if self.args.get('task_definition'):
-            return self.args.get('task_definition')
+        parser.add_argument(
+            '--write-rate',
+            type=float,
+            default=DEFAULT_WRITE_RATE,
+            help='Default is %(default)s. Maximum mutating calls per second, shared by \
+                every concurrent deploy.')
 
-        # use 'service_name' with describe_services() to get task definition
-        service = self.client_fn('describe_services')
-        arn = service['services'][0]['taskDefinition']
-        return arn.split('/')[1].split(':')[0]
+        parser.add_argument(
+            '--max-retries',
+            type=int,
+            default=DEFAULT_MAX_RETRIES,
+            help='Default is %(default)s. Retries, with exponential backoff, of calls \
+                that were throttled or failed with a server error.')
 
-    def _service_name(self):
-        if self.args.get('service_name'):
-            return self.args.get('service_name')
+        parser.add_argument(
+            '--metrics-out',
+            help='Write per API call and per phase timings to this file.')
 
-        # use 'task_definition' with list_services() to get service name
-        serviceArns = self.client_fn('list_services')['serviceArns']
-        service = [s for s in serviceArns if self.args.get('task_definition')
-                   in s][0]
-        return service.split('/')[1].split(':')[0]
+        parser.add_argument(
+            '--metrics-format',
+            choices=['json', 'prometheus'],
+            default='json',
+            help='Default is %(default)s. Format of --metrics-out: JSON lines or a \
+                Prometheus textfile.')
 
-    def _arg_kwargs(self, kwargs, arg_name, alt_name=None):
-        # add specified arg to kwargs if it exists, return kwargs
-        if self.args.get(arg_name):
-            kwarg_name = alt_name or arg_name
-            kwargs[kwarg_name] = self.args.get(arg_name)
-        return kwargs
+        parser.add_argument(
+            '--plan-file',
+            help='Plan file written by the plan command and deployed by the apply command.')
 
-    def client_kwargs(self, fn):
-        kwargs = {}
+        parser.add_argument(
+            '--status-format',
+            choices=['table', 'json'],
+            default='table',
+            help='Default is %(default)s. Output of the status command.')
 
-        if fn == 'list_services':
-            kwargs['cluster'] = self.cluster
+        parser.add_argument(
+            '--latest-revisions',
+            action='store_true',
+            help='Have the status command also describe the latest revision of each task \
+                definition family (one call per family), to flag outdated services.')
 
-        elif fn == 'describe_services':
-            kwargs['cluster'] = self.cluster
-            kwargs['services'] = [self.args.get('service_name')]
+        parser.add_argument(
+            '--credential-cache',
+            action='store_true',
+            help='Reuse the temporary credentials of an assume-role profile across runs, \
+                from the cache directory.')
 
-        elif fn == 'describe_task_definition':
-            kwargs['taskDefinition'] = self.task_definition_name
+        parser.add_argument(
+            '--credential-refresh-margin',
+            type=int,
+            default=DEFAULT_CREDENTIAL_REFRESH_MARGIN,
+            help='Default is %(default)ss. Cached credentials this close to expiring are \
+                refreshed.')
 
-        elif fn == 'register_task_definition':
-            kwargs['family'] = self.task_definition['family']
-            kwargs['containerDefinitions'] = self.task_definition['containerDefinitions']
-            # optional kwargs from args
-            if self.args.get('image'):
-                kwargs['containerDefinitions'][0]['image'] = self.args.get('image')
+        parser.add_argument(
+            '--listen',
+            help='Default is daemon.sock in the cache directory. host:port, or the path of a \
+                Unix socket, the serve command listens on. Jobs are not authenticated: the \
+                socket is only accessible to its owner, but a port is open to every local user.')
 
-        elif fn == 'update_service':
-            kwargs['cluster'] = self.cluster
-            kwargs['service'] = self.service_name
-            kwargs['taskDefinition'] = self.new_task_definition['family']
-            # optional kwargs from args
-            deployment_config = {}
-            deployment_config = self._arg_kwargs(deployment_config, 'min',
-                                                 'minimumHealthyPercent')
-            deployment_config = self._arg_kwargs(deployment_config, 'max',
-                                                 'maximumPercent')
-            kwargs['deploymentConfiguration'] = deployment_config
-            kwargs = self._arg_kwargs(kwargs, 'desired_count')
+        parser.add_argument(
+            '--cluster-concurrency',
+            type=int,
+            default=DEFAULT_CLUSTER_CONCURRENCY,
+            help='Default is %(default)s. Jobs the serve command deploys to a cluster at once; \
+                the others wait in line.')
 
-        elif fn == 'list_tasks':
-            kwargs['cluster'] = self.cluster
-            kwargs['serviceName'] = self.service_name
-            kwargs['desiredStatus'] = 'RUNNING'
+        parser.add_argument(
+            '--record',
+            help='Record every ECS call, with its response, to this cassette file.')
 
-        elif fn == 'describe_tasks':
-            kwargs['cluster'] = self.cluster
-            kwargs['tasks'] = self.client_fn('list_tasks')['taskArns']
+        parser.add_argument(
+            '--replay',
+            help='Serve ECS calls from this cassette file instead of AWS.')
 
-        return kwargs
+        parser.add_argument(
+            '--replay-latency',
+            type=float,
+            default=0.0,
+            help='Default is %(default)ss. Latency added to every replayed call.')
+
+        parser.add_argument(
+            '--pin-digests',
+            action='store_true',
+            help='Resolve tags of ECR images to digests, so that every task of a rollout \
+                runs the same image even if the tag is pushed again.')
+
+        parser.add_argument(
+            '--digest-cache-ttl',
+            type=int,
+            default=DEFAULT_DIGEST_CACHE_TTL,
+            help='Default is %(default)ss. How long resolved image digests may be reused \
+                (0 looks digests up on every run)')
+
+        parser.add_argument(
+            '--capacity-check',
+            choices=['warn', 'fail'],
+            help='Before updating a service, simulate placing the tasks its rollout needs on \
+                the free CPU and memory of the cluster\'s container instances, and warn or \
+                fail the deploy if they do not fit.')
+
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            help='Register a new revision and roll it out even if the task definition \
+                would not change.')
+
+        parser.add_argument(
+            '--max-definitions',
+            type=int,
+            help='Number of Task Definition Revisions to persist before \
+                deregistering oldest revisions. Revisions used by a service in the \
+                cluster, or in any cluster of the region deployed to, are always kept.')
+
+        parser.add_argument(
+            '--deregister-rate',
+            type=float,
+            default=DEFAULT_DEREGISTER_RATE,
+            help='Default is %(default)s. Maximum task definition deregistrations per second.')
+
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='List the task definition revisions that would be deregistered.')
+
+        args = parser.parse_args(sys.argv[1:])
+        return vars(args)
+
+    def _run_parser(self):
+        if self.args.get('command') == 'gc':
+            for family, arns in sorted(self.collect_task_definitions().items()):
+                if self.args.get('dry_run'):
+                    for arn in arns:
+                        print('Would deregister %s' % arn)
+                else:
+                    print('Deregistered %d revisions of %s' % (len(arns), family))
+            return 0
+
+        commands = {'serve': self._serve, 'status': self._status, 'plan': self._plan,
+                    'apply': self._apply}
+        if self.args.get('command') in commands:
+            return commands[self.args['command']]()
+
+        if self.args.get('command') == 'rollback':
+            results = self.rollback()
+            self._print_results(results)
+            return 0 if all(result.ok for result in results) else 1
+
+        manifest = load_manifest(self.args['manifest']) if self.args.get('manifest') else None
+        if len(self.regions) > 1 or len(self.clusters) > 1:
+            results = []
+            fan_out = self.deploy_regions(self.regions or [None], self.clusters or [None],
+                                          self.args.get('canary_region'), manifest)
+            for (region, cluster), target_results in fan_out.items():
+                print('[%s%s]' % ('%s/' % region if region else '', cluster or ''))
+                self._print_results(target_results)
+                results.extend(target_results)
+        else:
+            results = self.deploy_manifest(manifest) if manifest else self.deploy()
+            self._print_results(results)
+        return 0 if all(result.ok for result in results) else 1
 
-    def client_fn(self, fn):
+    def _serve(self):
+        # every option but the command and the daemon's own settings is a
+        # default of the jobs
+        defaults = dict((key, value) for key, value in self.args.items()
+                        if key not in ('command', 'listen', 'cluster_concurrency') and
+                        value is not None)
+        daemon = DeployDaemon(session=self.session,
+                              cluster_concurrency=self.args.get('cluster_concurrency'),
+                              **defaults)
+        address = self.args.get('listen') or \
+            os.path.join(self.args.get('cache_dir') or default_cache_dir(), DEFAULT_SOCKET)
+        server = daemon_server(daemon, address)
+        print('Listening on %s' % address)
+        sys.stdout.flush()
         try:
-            kwargs = self.client_kwargs(fn)
-            response = getattr(self.client, fn)(**kwargs)
-            return response
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        return 0
+
+    def _plan(self):
+        plan = self.plan()
+        with open(self.args['plan_file'], 'w') as f:
+            json.dump(plan, f, indent=2, sort_keys=True, default=str)
+        for entry in plan['services']:
+            if entry['action'] == 'register':
+                print('%s: new revision of %s' % (entry['service'], entry['family']))
+            elif entry['action'] == 'update':
+                print('%s: roll out %s' % (entry['service'], entry['task_definition']))
+            elif entry['action'] == 'watch':
+                print('%s: wait for the rollout of %s' %
+                      (entry['service'], entry['task_definition']))
+            else:
+                print('%s: no changes' % entry['service'])
+            for line in entry['diff']:
+                print('  %s' % line)
+        print('Plan written to %s' % self.args['plan_file'])
+        return 0
+
+    def _apply(self):
+        with open(self.args['plan_file']) as f:
+            plan = json.load(f)
+        if not self.regions and plan.get('region'):
+            # the client is not built yet, so it is built for the plan's region
+            self.args['region'] = plan['region']
+        results = self.apply(plan)
+        self._print_results(results)
+        return 0 if all(result.ok for result in results) else 1
+
+    def _status(self):
+        # summarize each region and cluster in turn; the describes of each
+        # are concurrent
+        if len(self.regions) > 1 or len(self.clusters) > 1:
+            targets = sorted(self._region_deployers(self.regions or [None],
+                                                    self.clusters or [None]).items())
+        else:
+            targets = [((self.args.get('region'), self.args.get('cluster')), self)]
+        summaries = []
+        for (region, cluster), deployer in targets:
+            target_summaries = deployer.status()
+            if self.args.get('status_format') != 'json':
+                if len(targets) > 1:
+                    print('[%s%s]' % ('%s/' % region if region else '', cluster or ''))
+                print(format_status(target_summaries))
+            for summary in target_summaries:
+                summary.update(region=region, cluster=cluster)
+            summaries.extend(target_summaries)
+        if self.args.get('status_format') == 'json':
+            print(json.dumps(summaries, indent=2, sort_keys=True, default=str))
+        return 0
+
+    def _print_event(self, service_name, event):
+        if self.args.get('events_format') == 'json':
+            print(format_event(service_name, event, 'json'))
+        else:
+            print('[%s] %s' % (service_name, format_event(service_name, event)))
+        sys.stdout.flush()
+
+    def _print_results(self, results):
+        for result in results:
+            if result.status == 'unchanged':
+                print('%s: OK (already running %s)' % (result.service,
+                                                      result.task_definition_arn))
+            elif result.status == 'rolled_back':
+                print('%s: OK (rolled back to %s)' % (result.service,
+                                                     result.task_definition_arn))
+            else:
+                print('%s: %s (%.1fs)' % (result.service, 'OK' if result.ok else
+                                          result.status.upper(), result.elapsed))
+            if result.cause:
+                print('  %s' % result.cause)
 
-        except ClientError as e:
-            print('ClientError: %s' % e)
-            sys.exit(1)
-        except Exception as e:
-            print('Exception: %s' % e)
-            sys.exit(1)
 
 if __name__ == '__main__':
     CLI()
@@ -0,0 +1,260 @@
+"""Deploy benchmarks: API call counts and end to end time of realistic deploys.
+
+Each scenario deploys against a simulated ECS cluster once, recording every
+call to a cassette, then replays the cassette offline with a fixed latency per
+call. Polls sleep on a virtual clock, so the measured time is spent in
+ecs_deploy and in the (replayed) API calls only.
+
+The tests hold the call counts against regressions; run this file as a script
+for a report::
+
+    $ python tests/test_benchmark.py --latency 0.02
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+from collections import Counter, namedtuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ecs_deploy import Deployer, PollScheduler, ReplayClient  # noqa: E402
+
+# replayed latency of every call in the tests, in seconds
+TEST_LATENCY = 0.001
+
+Scenario = namedtuple('Scenario', 'name services tasks polls failed_tasks')
+
+SCENARIOS = [
+    Scenario('single service', 1, 2, 3, 0),
+    Scenario('50 services', 50, 2, 3, 0),
+    Scenario('1,000 tasks', 1, 1000, 5, 1),
+]
+
+# the status command, describing every service of a cluster
+STATUS_SCENARIO = Scenario('status, 500 svcs', 500, 2, 3, 0)
+
+Benchmark = namedtuple('Benchmark', 'scenario calls seconds virtual_seconds ok')
+
+
+class FakeECS(object):
+    """A cluster of services that roll out over a number of describe_services polls.
+
+    Each service runs ``tasks`` tasks. A rollout replaces them over ``polls``
+    polls, leaving the old tasks and ``failed_tasks`` tasks of the new revision
+    stopped.
+    """
+
+    def __init__(self, services, tasks, polls, failed_tasks):
+        self.meta = namedtuple('ClientMeta', 'region_name')('us-east-1')
+        self.tasks = tasks
+        self.polls = polls
+        self.failed_tasks = failed_tasks
+        self.revisions = {}
+        self.services = {}
+        for i in range(services):
+            name = 'svc-%02d' % i
+            self.revisions[name] = 1
+            self.services[name] = {'serviceName': name, 'taskDefinition': self._arn(name, 1),
+                                   'desiredCount': tasks, 'runningCount': tasks,
+                                   'events': [], 'polls': 0,
+                                   'deployments': [self._deployment(name, 1, tasks)]}
+
+    def _arn(self, family, revision):
+        return 'arn:aws:ecs:us-east-1:123456789012:task-definition/%s:%d' % (family, revision)
+
+    def _deployment(self, family, revision, running):
+        return {'taskDefinition': self._arn(family, revision), 'status': 'PRIMARY',
+                'desiredCount': self.tasks, 'runningCount': running, 'pendingCount': 0,
+                'failedTasks': 0, 'createdAt': 0}
+
+    def describe_task_definition(self, taskDefinition):
+        family = taskDefinition.split('/')[-1].split(':')[0]
+        revision = self.revisions[family]
+        return {'taskDefinition': {
+            'taskDefinitionArn': self._arn(family, revision), 'family': family,
+            'revision': revision, 'containerDefinitions': [
+                {'name': 'app', 'image': 'repo/app:%d' % revision, 'cpu': 256, 'memory': 512}]}}
+
+    def register_task_definition(self, family, containerDefinitions):
+        self.revisions[family] += 1
+        return self.describe_task_definition(family)
+
+    def update_service(self, cluster, service, taskDefinition, deploymentConfiguration):
+        # taskDefinition is a family, for its latest revision, or a revision arn
+        state = self.services[service]
+        family = taskDefinition.split('/')[-1].split(':')[0]
+        revision = int(taskDefinition.split(':')[-1]) if '/' in taskDefinition else \
+            self.revisions[family]
+        deployment = self._deployment(family, revision, 0)
+        deployment['createdAt'] = 1
+        state['taskDefinition'] = deployment['taskDefinition']
+        for previous in state['deployments']:
+            previous['status'] = 'ACTIVE'
+        state['deployments'].insert(0, deployment)
+        state['polls'] = 0
+        return {'service': self._public(state)}
+
+    def describe_services(self, cluster, services):
+        described = []
+        for name in services:
+            state = self.services[name.split('/')[-1]]
+            state['polls'] += 1
+            new = state['deployments'][0]
+            if len(state['deployments']) > 1 and new['runningCount'] < self.tasks:
+                new['runningCount'] = min(self.tasks, self.tasks * state['polls'] // self.polls)
+                new['failedTasks'] = self.failed_tasks
+                state['events'].insert(0, {
+                    'id': '%s-%d' % (name, state['polls']), 'createdAt': 1 + state['polls'],
+                    'message': '(service %s) has started %d tasks.' % (name, new['runningCount'])})
+                if new['runningCount'] >= self.tasks:
+                    # the old deployments drain once the new one is complete
+                    del state['deployments'][1:]
+            described.append(self._public(state))
+        return {'services': described, 'failures': []}
+
+    def _public(self, state):
+        return dict((key, value) for key, value in state.items() if key != 'polls')
+
+    def list_services(self, cluster, maxResults=10, nextToken=None):
+        arns = ['arn:aws:ecs:us-east-1:123456789012:service/bench/%s' % name
+                for name in sorted(self.services)]
+        start = int(nextToken or 0)
+        page = {'serviceArns': arns[start:start + maxResults]}
+        if start + maxResults < len(arns):
+            page['nextToken'] = str(start + maxResults)
+        return page
+
+    def list_tasks(self, cluster, serviceName, desiredStatus, nextToken=None):
+        # the old revision's tasks, and the new revision's failed tasks, once stopped
+        arns = ['arn:aws:ecs:us-east-1:123456789012:task/bench/%s-%d' % (serviceName, i)
+                for i in range(self.tasks + self.failed_tasks)]
+        start = int(nextToken or 0)
+        page = {'taskArns': arns[start:start + 100]}
+        if start + 100 < len(arns):
+            page['nextToken'] = str(start + 100)
+        return page
+
+    def describe_tasks(self, cluster, tasks):
+        described = []
+        for arn in tasks:
+            service, i = arn.split('/')[-1].rsplit('-', 1)
+            revision = self.revisions[service] - (1 if int(i) < self.tasks else 0)
+            described.append({'taskArn': arn, 'taskDefinitionArn': self._arn(service, revision),
+                              'stoppedReason': 'Essential container in task exited',
+                              'containers': [{'name': 'app', 'exitCode': 1}]})
+        return {'tasks': described, 'failures': []}
+
+
+class VirtualClock(object):
+    """Clock for poll schedulers that sleep without waiting."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def deploy(scenario, client, **options):
+    # deploy every service of the scenario; returns (ok, metrics, seconds,
+    # virtual seconds)
+    clock = VirtualClock()
+    deployer = Deployer(client=client, cluster='bench', image='repo/app:2',
+                        service_name=['svc-%02d' % i for i in range(scenario.services)],
+                        timeout=3600, failure_threshold=3, read_rate=100000,
+                        write_rate=100000, **options)
+    deployer.poll_scheduler = lambda timeout: PollScheduler(timeout, clock=clock.clock,
+                                                            sleep=clock.sleep)
+    start = time.time()
+    results = deployer.deploy()
+    return all(result.ok for result in results), deployer.metrics, time.time() - start, \
+        clock.now
+
+
+def status(scenario, client, **options):
+    # summarize every service of the scenario's cluster
+    deployer = Deployer(client=client, cluster='bench', read_rate=100000, **options)
+    start = time.time()
+    summaries = deployer.status()
+    ok = len(summaries) == scenario.services and \
+        all(summary['state'] == 'steady' for summary in summaries)
+    return ok, deployer.metrics, time.time() - start, 0.0
+
+
+def benchmark(scenario, latency, cassette_dir, run=deploy):
+    # record the scenario against the simulated cluster, then replay it
+    cassette = os.path.join(cassette_dir, '%s.jsonl' % scenario.name.replace(' ', '-'))
+    run(scenario, FakeECS(*scenario[1:]), record=cassette)
+    ok, metrics, seconds, virtual_seconds = run(
+        scenario, ReplayClient(cassette, latency, 'us-east-1'))
+    return Benchmark(scenario, Counter(call['call'] for call in metrics.calls), seconds,
+                     virtual_seconds, ok)
+
+
+def report(benchmarks):
+    print('%-16s %7s %9s %9s  %s' % ('scenario', 'calls', 'seconds', 'virtual', 'calls by API'))
+    for b in benchmarks:
+        print('%-16s %7d %9.3f %9.1f  %s' % (
+            b.scenario.name, sum(b.calls.values()), b.seconds, b.virtual_seconds,
+            ', '.join('%s=%d' % item for item in sorted(b.calls.items()))))
+
+
+class TestBenchmark(object):
+
+    def benchmark(self, scenario, run=deploy):
+        cassette_dir = tempfile.mkdtemp()
+        try:
+            result = benchmark(scenario, TEST_LATENCY, cassette_dir, run)
+        finally:
+            shutil.rmtree(cassette_dir)
+        assert result.ok
+        return result
+
+    def test_single_service(self):
+        result = self.benchmark(SCENARIOS[0])
+        # one describe_services resolves the task definition, three poll
+        assert result.calls == {'describe_task_definition': 1, 'register_task_definition': 1,
+                                'update_service': 1, 'describe_services': 1 + 3}
+
+    def test_50_services(self):
+        result = self.benchmark(SCENARIOS[1])
+        # each service's task definition is resolved on its own, but every poll
+        # describes all 50 services in batches of 10
+        assert result.calls == {'describe_task_definition': 50, 'register_task_definition': 50,
+                                'update_service': 50, 'describe_services': 50 + 3 * 5}
+
+    def test_1000_tasks(self):
+        result = self.benchmark(SCENARIOS[2])
+        # stopped tasks are listed in pages of 100 and described in batches of
+        # 100, only on the poll where the rollout's failed tasks went up
+        calls = dict(result.calls)
+        assert calls.pop('describe_services') == 1 + 5
+        assert calls.pop('list_tasks') == calls.pop('describe_tasks') == 11
+        assert calls == {'describe_task_definition': 1, 'register_task_definition': 1,
+                         'update_service': 1}
+
+    def test_status_500_services(self):
+        result = self.benchmark(STATUS_SCENARIO, status)
+        # services are listed in pages of 100 and described in batches of 10
+        assert result.calls == {'list_services': 5, 'describe_services': 50}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark deploys against replayed ECS calls')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='Default is %(default)ss. Latency of every replayed call.')
+    args = parser.parse_args()
+    cassette_dir = tempfile.mkdtemp()
+    try:
+        report([benchmark(scenario, args.latency, cassette_dir) for scenario in SCENARIOS] +
+               [benchmark(STATUS_SCENARIO, args.latency, cassette_dir, status)])
+    finally:
+        shutil.rmtree(cassette_dir)
@@ -1,8 +1,31 @@
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+from collections import OrderedDict
+from datetime import datetime
+
 import mock
 import boto3
+import pytest
+from botocore.exceptions import ClientError
 from moto import mock_ecs
 
-from ecs_deploy import CLI
+from ecs_deploy import CLI, MAX_DESCRIBE_SERVICES, MAX_DESCRIBE_TASKS, PollScheduler, \
+    ClientCallError, Deployer, DeployError, Metrics, RateLimiter, TaskDefinitionCache, \
+    DeployResult, TokenBucket, deploy_waves, manifest_services, rollout_complete, \
+    split_list, task_definition_digest, EventFollower, format_event, ClusterCapacity, \
+    rollout_placements, task_reservation, ImageResolver, Cassette, ReplayClient, DeployDaemon, \
+    daemon_server, CredentialCache, service_summary, format_status, container_index, \
+    image_repository, client_lock
+from tests.test_benchmark import FakeECS, VirtualClock
+
+# import time budget for ecs_deploy itself, in microseconds
+IMPORT_TIME_BUDGET_US = 100000
 
 
 class TestCLI(object):
@@ -126,6 +149,7 @@ class TestCLI(object):
             'image': 'mock_image'
         }
 
+        self.mock_cli.client = self.client
         self.mock_cli.cluster = mock_cluster['cluster']
         self.mock_cli.task_definition = mock_task['taskDefinition']
         self.mock_cli.service = mock_service
@@ -164,21 +188,44 @@ class TestCLI(object):
 
     def test_service_name_without_arg(self):
         mock_cli, client = self.setUp()
+        mock_cli.client = client
+        mock_cli.args['cache_dir'] = tempfile.mkdtemp()
+        mock_cli.args['service_index_ttl'] = 60
+        mock_cli.cluster = mock_cli.args['cluster']
+        responses = {
+            'list_services': {'serviceArns': [mock_cli.service['service']['serviceArn']]},
+            'describe_services': {'services': [
+                {'serviceName': 'mock_task-service',
+                 'taskDefinition': mock_cli.task_definition['taskDefinitionArn']},
+                {'serviceName': 'mock_task-worker-service',
+                 'taskDefinition': 'arn:aws:ecs:us-east-1:9:task-definition/mock_task-worker:1'}
+            ]}
+        }
 
-        with mock.patch.object(mock_cli, 'client_fn') as mock_fn:
-            mock_list_services_response = {
-                'serviceArns': [
-                    mock_cli.service['service']['serviceArn']
-                ]
-            }
-            mock_fn.return_value = mock_list_services_response
+        with mock.patch.object(mock_cli, 'client_fn',
+                               side_effect=lambda fn, **kwargs: responses[fn]) as mock_fn:
             service_name = mock_cli.args['service_name']
             mock_cli.args['service_name'] = None
 
             mock_service_name = mock_cli._service_name()
 
             assert mock_service_name == service_name
-            mock_fn.assert_called_once_with('list_services')
+            assert mock_fn.call_count == 2
+
+            # the index is reused from the cache directory
+            assert mock_cli._service_name() == service_name
+            assert mock_fn.call_count == 2
+
+        shutil.rmtree(mock_cli.args['cache_dir'])
+
+    def test_service_name_without_arg_ambiguous(self):
+        mock_cli, client = self.setUp()
+        mock_cli.args['service_name'] = None
+
+        with mock.patch.object(mock_cli, '_service_index',
+                               return_value={'mock_task': ['service-a', 'service-b']}):
+            with pytest.raises(DeployError):
+                mock_cli._service_name()
 
     def test_arg_kwargs_add_arg(self):
         mock_cli, client = self.setUp()
@@ -251,6 +298,19 @@ class TestCLI(object):
         assert 'min' or 'minimumHealthyPercent' or 'max' or 'maximumPercent' \
             not in mock_kwargs['deploymentConfiguration']
 
+    def test_client_kwargs_with_update_service_revision(self):
+        mock_cli, client = self.setUp()
+        mock_cli.new_task_definition = {
+            'family': 'new_mock_task',
+            'taskDefinitionArn':
+                'arn:aws:ecs:us-east-1:123456789012:task-definition/new_mock_task:2'
+        }
+        mock_cli.service_name = mock_cli.args['service_name']
+        mock_kwargs = mock_cli.client_kwargs('update_service')
+
+        assert mock_kwargs['taskDefinition'] == \
+            mock_cli.new_task_definition['taskDefinitionArn']
+
     def test_client_kwargs_with_update_service_min(self):
         mock_cli, client = self.setUp()
         mock_cli.new_task_definition = {
@@ -313,8 +373,8 @@ class TestCLI(object):
         assert 'service' in mock_kwargs
         assert 'taskDefinition' in mock_kwargs
         assert 'deploymentConfiguration' in mock_kwargs
-        assert 'desired_count' in mock_kwargs
-        assert mock_kwargs['desired_count'] == mock_cli.args['desired_count']
+        assert 'desiredCount' in mock_kwargs
+        assert mock_kwargs['desiredCount'] == mock_cli.args['desired_count']
         assert mock_kwargs['cluster']['clusterName'] == \
             mock_cli.args['cluster']
         assert mock_kwargs['service'] == mock_cli.service_name
@@ -364,3 +424,1383 @@ class TestCLI(object):
                 client, 'list_services', return_value={'key': 'value'}) as mock_client:
             mock_cli.client_fn('list_services')
             mock_client.assert_called_once
+
+    def test_deployment_scopes_args_to_service(self):
+        mock_cli, client = self.setUp()
+        deployment = mock_cli._deployment('other-service')
+
+        assert deployment.args['service_name'] == 'other-service'
+        assert mock_cli.args['service_name'] != 'other-service'
+        assert deployment.cluster is mock_cli.cluster
+
+    def test_run_parser_with_multiple_services(self):
+        mock_cli, client = self.setUp()
+        mock_cli.args['service_name'] = ['service-a', 'service-b', 'service-c']
+        mock_cli.args['workers'] = 2
+        started = []
+
+        def mock_start(deployment):
+            name = deployment.args['service_name']
+            started.append(name)
+            deployment.service_name = name
+            deployment.new_task_definition = {'taskDefinitionArn': 'arn/%s:2' % name}
+            return name != 'service-b'
+
+        def mock_watch(cli, targets):
+            assert sorted(targets) == ['service-a', 'service-c']
+            return dict((name, 0) for name in targets), {}
+
+        with mock.patch.object(CLI, '_start', autospec=True, side_effect=mock_start), \
+                mock.patch.object(CLI, '_watch', autospec=True, side_effect=mock_watch):
+            assert mock_cli._run_parser() == 1
+
+        assert sorted(started) == mock_cli.args['service_name']
+
+    def test_deploy_reports_missing_service_as_failed(self):
+        ecs = FakeECS(1, 2, 2, 0)
+        describe_services = ecs.describe_services
+
+        def mock_describe_services(cluster, services):
+            if 'missing' in services:
+                return {'services': [], 'failures': [{'arn': 'missing', 'reason': 'MISSING'}]}
+            return describe_services(cluster, services)
+
+        ecs.describe_services = mock_describe_services
+        clock = VirtualClock()
+        deployer = Deployer(client=ecs, cluster='bench', service_name=['svc-00', 'missing'],
+                            image='repo/app:2', journal=False, timeout=60)
+        deployer.poll_scheduler = lambda timeout: PollScheduler(timeout, clock=clock.clock,
+                                                                sleep=clock.sleep)
+        results = deployer.deploy()
+
+        assert [(r.service, r.status) for r in results] == \
+            [('svc-00', 'deployed'), ('missing', 'failed')]
+        assert 'MISSING' in results[1].cause
+
+    def test_start_service_fails_on_unexpected_errors(self):
+        deployment = mock.Mock()
+        deployment._start.side_effect = KeyError('taskDefinition')
+        assert Deployer._start_service(deployment) == "KeyError: 'taskDefinition'"
+
+    def test_run_parser_with_multiple_services_success(self):
+        mock_cli, client = self.setUp()
+        mock_cli.args['service_name'] = ['service-a', 'service-b']
+
+        def mock_start(deployment):
+            deployment.service_name = deployment.args['service_name']
+            deployment.new_task_definition = {'taskDefinitionArn': 'arn'}
+            return True
+
+        with mock.patch.object(CLI, '_start', autospec=True, side_effect=mock_start), \
+                mock.patch.object(CLI, '_watch',
+                                  return_value=({'service-a': 0, 'service-b': 0}, {})):
+            assert mock_cli._run_parser() == 0
+
+    def test_rollout_complete(self):
+        service = {
+            'deployments': [
+                {'taskDefinition': 'arn:new', 'desiredCount': 2, 'runningCount': 2,
+                 'pendingCount': 0},
+                {'taskDefinition': 'arn:old', 'desiredCount': 0, 'runningCount': 2,
+                 'pendingCount': 0}
+            ]
+        }
+        assert rollout_complete(service, 'arn:new')
+        assert not rollout_complete(service, 'arn:missing')
+
+        service['deployments'][0]['pendingCount'] = 1
+        assert not rollout_complete(service, 'arn:new')
+
+    def test_watch_batches_describe_services(self):
+        mock_cli, client = self.setUp()
+        targets = dict(('service-%02d' % i, 'arn:new') for i in range(15))
+
+        def mock_client_fn(fn, services):
+            assert fn == 'describe_services'
+            assert len(services) <= MAX_DESCRIBE_SERVICES
+            return {'services': [{
+                'serviceName': name,
+                'deployments': [{'taskDefinition': 'arn:new', 'desiredCount': 1,
+                                 'runningCount': 1, 'pendingCount': 0}]
+            } for name in services]}
+
+        with mock.patch.object(mock_cli, 'client_fn', side_effect=mock_client_fn) as mock_fn:
+            finished, failed = mock_cli._watch(targets)
+
+        assert sorted(finished) == sorted(targets)
+        assert mock_fn.call_count == 2
+
+    def test_client_kwargs_with_describe_tasks_override(self):
+        mock_cli, client = self.setUp()
+
+        with mock.patch.object(mock_cli, 'client_fn') as mock_fn:
+            mock_kwargs = mock_cli.client_kwargs('describe_tasks', tasks=['arn:task'])
+
+            assert mock_kwargs['tasks'] == ['arn:task']
+            assert not mock_fn.called
+
+    def test_tasks_pages_and_batches(self):
+        mock_cli, client = self.setUp()
+        mock_cli.args['workers'] = 3
+        pages = {
+            None: {'taskArns': ['task-%03d' % i for i in range(150)], 'nextToken': 'page-2'},
+            'page-2': {'taskArns': ['task-%03d' % i for i in range(150, 250)]}
+        }
+
+        def mock_client_fn(fn, **kwargs):
+            if fn == 'list_tasks':
+                assert kwargs['desiredStatus'] == 'STOPPED'
+                return pages[kwargs.get('nextToken')]
+            assert len(kwargs['tasks']) <= MAX_DESCRIBE_TASKS
+            return {'tasks': [{'taskArn': arn} for arn in kwargs['tasks']]}
+
+        with mock.patch.object(mock_cli, 'client_fn', side_effect=mock_client_fn) as mock_fn:
+            tasks = list(mock_cli._tasks(desiredStatus='STOPPED'))
+
+        assert sorted(t['taskArn'] for t in tasks) == ['task-%03d' % i for i in range(250)]
+        # two list_tasks pages and three describe_tasks batches
+        assert mock_fn.call_count == 5
+
+    def test_poll_scheduler_backs_off_while_stable(self):
+        scheduler = PollScheduler(60, min_interval=1, max_interval=8, jitter=0,
+                                  clock=lambda: 0)
+
+        assert [scheduler.next_delay(False) for _ in range(5)] == [2, 4, 8, 8, 8]
+        assert scheduler.next_delay(True) == 1
+
+    def test_poll_scheduler_clamps_to_deadline(self):
+        now = [0.0]
+        slept = []
+
+        def mock_sleep(delay):
+            slept.append(delay)
+            now[0] += delay
+
+        scheduler = PollScheduler(10, min_interval=4, max_interval=4, jitter=0,
+                                  clock=lambda: now[0], sleep=mock_sleep)
+        while not scheduler.expired():
+            scheduler.wait(False)
+
+        assert slept == [4, 4, 2]
+        assert now[0] == 10
+
+    def test_watch_times_out(self):
+        mock_cli, client = self.setUp()
+        mock_cli.args['timeout'] = 5
+        now = [0.0]
+
+        def mock_scheduler(timeout):
+            def mock_sleep(delay):
+                now[0] += delay
+            return PollScheduler(timeout, clock=lambda: now[0], sleep=mock_sleep)
+
+        mock_cli.poll_scheduler = mock_scheduler
+        response = {'services': [{
+            'serviceName': 'mock_task-service',
+            'deployments': [{'taskDefinition': 'arn:new', 'desiredCount': 1,
+                             'runningCount': 0, 'pendingCount': 1}]
+        }]}
+
+        with mock.patch.object(mock_cli, 'client_fn', return_value=response):
+            assert mock_cli._watch({'mock_task-service': 'arn:new'}) == ({}, {})
+
+        assert now[0] == 5
+
+    def test_watch_fails_fast_on_stopped_tasks(self):
+        mock_cli, client = self.setUp()
+        mock_cli.args['failure_threshold'] = 2
+        mock_cli.poll_scheduler = lambda timeout: PollScheduler(timeout, sleep=lambda delay: None)
+        response = {'services': [{
+            'serviceName': 'mock_task-service',
+            'deployments': [{'taskDefinition': 'arn:new', 'desiredCount': 1,
+                             'runningCount': 0, 'pendingCount': 0, 'failedTasks': 2}],
+            'events': []
+        }]}
+        stopped = [
+            {'taskArn': 'arn:task/old', 'taskDefinitionArn': 'arn:old'},
+            {'taskArn': 'arn:task/a', 'taskDefinitionArn': 'arn:new',
+             'stoppedReason': 'Essential container in task exited',
+             'containers': [{'name': 'app', 'exitCode': 1}]},
+            {'taskArn': 'arn:task/b', 'taskDefinitionArn': 'arn:new',
+             'stoppedReason': 'Essential container in task exited',
+             'containers': [{'name': 'app', 'exitCode': 137}]}
+        ]
+
+        with mock.patch.object(mock_cli, 'client_fn', return_value=response), \
+                mock.patch.object(mock_cli, '_tasks', return_value=iter(stopped)) as mock_tasks:
+            finished, failed = mock_cli._watch({'mock_task-service': 'arn:new'})
+
+        mock_tasks.assert_called_once_with(serviceName='mock_task-service',
+                                           desiredStatus='STOPPED')
+        assert finished == {}
+        assert failed['mock_task-service'] == \
+            'task b stopped: Essential container in task exited (exit codes: app=137)'
+
+    def test_watch_fails_fast_on_placement_failures(self):
+        mock_cli, client = self.setUp()
+        mock_cli.args['failure_threshold'] = 1
+        message = '(service mock_task-service) was unable to place a task because no ' \
+            'container instance met all of its requirements.'
+        response = {'services': [{
+            'serviceName': 'mock_task-service',
+            'deployments': [{'taskDefinition': 'arn:new', 'desiredCount': 1,
+                             'runningCount': 0, 'pendingCount': 0, 'failedTasks': 0,
+                             'createdAt': 10}],
+            'events': [{'id': 'new', 'createdAt': 20, 'message': message},
+                       {'id': 'old', 'createdAt': 5, 'message': message}]
+        }]}
+
+        with mock.patch.object(mock_cli, 'client_fn', return_value=response), \
+                mock.patch.object(mock_cli, '_tasks') as mock_tasks:
+            finished, failed = mock_cli._watch({'mock_task-service': 'arn:new'})
+
+        assert not mock_tasks.called
+        assert failed == {'mock_task-service': message}
+
+    def test_event_follower_yields_new_events_oldest_first(self):
+        follower = EventFollower(since=10)
+        service = {'events': [{'id': 'b', 'createdAt': 20, 'message': 'b'},
+                              {'id': 'a', 'createdAt': 15, 'message': 'a'},
+                              {'id': 'old', 'createdAt': 5, 'message': 'old'}]}
+
+        assert [e['id'] for e in follower.follow(service)] == ['a', 'b']
+        assert list(follower.follow(service)) == []
+
+        service['events'].insert(0, {'id': 'c', 'createdAt': 30, 'message': 'c'})
+        assert [e['id'] for e in follower.follow(service)] == ['c']
+
+    def test_watch_streams_events(self):
+        mock_cli, client = self.setUp()
+        mock_cli.on_event = mock.Mock()
+        deployment = {'taskDefinition': 'arn:new', 'desiredCount': 1, 'runningCount': 0,
+                      'pendingCount': 0, 'createdAt': 10}
+        pending = {'services': [{
+            'serviceName': 'mock_task-service', 'deployments': [deployment],
+            'events': [{'id': 'a', 'createdAt': 15, 'message': 'started 1 task'},
+                       {'id': 'old', 'createdAt': 5, 'message': 'old'}]}]}
+        steady = {'services': [{
+            'serviceName': 'mock_task-service',
+            'deployments': [dict(deployment, runningCount=1)],
+            'events': [{'id': 'b', 'createdAt': 20, 'message': 'reached a steady state'}] +
+            pending['services'][0]['events']}]}
+
+        mock_cli.poll_scheduler = lambda timeout: PollScheduler(timeout, sleep=lambda delay: None)
+        with mock.patch.object(mock_cli, 'client_fn', side_effect=[pending, steady]):
+            finished, failed = mock_cli._watch({'mock_task-service': 'arn:new'})
+
+        assert list(finished) == ['mock_task-service'] and not failed
+        assert [c[0][1]['id'] for c in mock_cli.on_event.call_args_list] == ['a', 'b']
+
+    def test_format_event(self):
+        event = {'id': 'a', 'createdAt': datetime(2020, 1, 2, 3, 4, 5), 'message': 'hi'}
+        assert format_event('svc', event) == '2020-01-02T03:04:05 hi'
+        assert json.loads(format_event('svc', event, 'json')) == {
+            'service': 'svc', 'id': 'a', 'createdAt': '2020-01-02T03:04:05', 'message': 'hi'}
+
+    def test_watch_fails_on_circuit_breaker(self):
+        mock_cli, client = self.setUp()
+        response = {'services': [{
+            'serviceName': 'mock_task-service',
+            'deployments': [{'taskDefinition': 'arn:new', 'desiredCount': 1,
+                             'runningCount': 0, 'pendingCount': 0,
+                             'rolloutState': 'FAILED', 'rolloutStateReason': 'circuit breaker'}]
+        }]}
+
+        with mock.patch.object(mock_cli, 'client_fn', return_value=response):
+            assert mock_cli._watch({'mock_task-service': 'arn:new'}) == \
+                ({}, {'mock_task-service': 'circuit breaker'})
+
+    def test_task_definition_digest_ignores_empty_values(self):
+        mock_cli, client = self.setUp()
+        registration = mock_cli.client_kwargs('register_task_definition')
+        described = dict(mock_cli.task_definition, revision=7)
+        described['containerDefinitions'] = [
+            dict(c, image='mock_image', secrets=[], systemControls=[])
+            for c in described['containerDefinitions']]
+
+        assert task_definition_digest(registration) == task_definition_digest(described)
+        assert task_definition_digest(registration) != \
+            task_definition_digest(mock_cli.task_definition)
+
+    def test_client_kwargs_with_register_task_definition_copies(self):
+        mock_cli, client = self.setUp()
+        mock_cli.client_kwargs('register_task_definition')
+
+        assert mock_cli.task_definition['containerDefinitions'][0]['image'] == \
+            'original_image'
+
+    def test_start_skips_unchanged_task_definition(self):
+        mock_cli, client = self.setUp()
+        mock_cli.args['image'] = 'original_image'
+        arn = mock_cli.task_definition['taskDefinitionArn']
+        deployment = {'taskDefinition': arn, 'status': 'PRIMARY', 'desiredCount': 2,
+                      'runningCount': 2}
+        responses = {
+            'describe_task_definition': {'taskDefinition': mock_cli.task_definition},
+            'describe_services': {'services': [{'taskDefinition': arn,
+                                                'deployments': [deployment]}]}
+        }
+
+        with mock.patch.object(mock_cli, 'client_fn',
+                               side_effect=lambda fn, **kwargs: responses[fn]) as mock_fn:
+            assert mock_cli._start()
+
+        assert mock_cli.unchanged
+        assert mock_cli.new_task_definition is mock_cli.task_definition
+        assert [c[0][0] for c in mock_fn.call_args_list] == \
+            ['describe_task_definition', 'describe_services']
+
+    def test_deploy_retry_watches_unfinished_rollout(self):
+        ecs = FakeECS(1, 2, 10 ** 6, 0)
+        clock = VirtualClock()
+        deployer = Deployer(client=ecs, cluster='bench', service_name=['svc-00'],
+                            image='repo/app:2', journal=False, timeout=60)
+        deployer.poll_scheduler = lambda timeout: PollScheduler(timeout, clock=clock.clock,
+                                                                sleep=clock.sleep)
+        assert [r.status for r in deployer.deploy()] == ['timeout']
+
+        # the retry reuses the revision without updating, and still waits for it
+        entry = deployer.plan()['services'][0]
+        assert (entry['action'], entry['diff']) == ('watch', [])
+        ecs.update_service = mock.Mock(side_effect=ecs.update_service)
+        results = deployer.deploy()
+        assert [(r.status, r.task_definition_arn) for r in results] == \
+            [('timeout', ecs.services['svc-00']['taskDefinition'])]
+        assert not ecs.update_service.called
+
+    def test_start_updates_settings_of_unchanged_task_definition(self):
+        mock_cli, client = self.setUp()
+        mock_cli.args['image'] = 'original_image'
+        mock_cli.args['desired_count'] = 10
+        mock_cli.args['journal'] = False
+        arn = mock_cli.task_definition['taskDefinitionArn']
+        responses = {
+            'describe_task_definition': {'taskDefinition': mock_cli.task_definition},
+            'describe_services': {'services': [{'taskDefinition': arn, 'desiredCount': 2}]},
+            'update_service': {'service': {}}
+        }
+
+        with mock.patch.object(mock_cli, 'client_fn',
+                               side_effect=lambda fn, **kwargs: responses[fn]) as mock_fn:
+            assert mock_cli._start()
+
+        assert not mock_cli.unchanged
+        assert mock_fn.call_args_list[-1] == mock.call('update_service')
+        assert mock_cli.client_kwargs('update_service')['desiredCount'] == 10
+        assert mock_cli.client_kwargs('update_service')['taskDefinition'] == arn
+
+    def test_start_forced_registers_unchanged_task_definition(self):
+        mock_cli, client = self.setUp()
+        mock_cli.args['image'] = 'original_image'
+        mock_cli.args['force'] = True
+        responses = {
+            'describe_task_definition': {'taskDefinition': mock_cli.task_definition},
+            'register_task_definition': {'taskDefinition': {'family': 'mock_task'}},
+            'update_service': {'service': {}}
+        }
+
+        with mock.patch.object(mock_cli, 'client_fn',
+                               side_effect=lambda fn, **kwargs: responses[fn]) as mock_fn:
+            assert mock_cli._start()
+
+        assert not mock_cli.unchanged
+        assert [c[0][0] for c in mock_fn.call_args_list] == \
+            ['describe_task_definition', 'register_task_definition', 'update_service']
+
+    def test_collect_task_definitions(self):
+        mock_cli, client = self.setUp()
+        mock_cli.args['max_definitions'] = 2
+        mock_cli.args['deregister_rate'] = 1000
+        arn = 'arn:aws:ecs:us-east-1:999999999999:task-definition/%s:%d'
+        pages = {
+            None: {'taskDefinitionArns': [arn % ('mock_task', 9), arn % ('mock_task', 8),
+                                          arn % ('mock_task-worker', 7), arn % ('mock_task', 7)],
+                   'nextToken': 'page-2'},
+            'page-2': {'taskDefinitionArns': [arn % ('mock_task', 6), arn % ('mock_task', 5)]}
+        }
+        deregistered = []
+
+        def mock_client_fn(fn, **kwargs):
+            if fn == 'list_task_definitions':
+                assert kwargs['familyPrefix'] == 'mock_task'
+                return pages[kwargs.get('nextToken')]
+            deregistered.append(kwargs['taskDefinition'])
+
+        with mock.patch.object(mock_cli, '_services',
+                               return_value=iter([{'taskDefinition': arn % ('mock_task', 6)}])), \
+                mock.patch.object(mock_cli, 'client_fn', side_effect=mock_client_fn):
+            stale = mock_cli._collect_task_definitions('mock_task')
+
+        assert stale == [arn % ('mock_task', 7), arn % ('mock_task', 5)]
+        assert sorted(deregistered) == sorted(stale)
+
+    def test_task_definitions_in_use_across_region_clusters(self):
+        deployer = Deployer(client=mock.Mock(), cluster='a', region_clusters=['a', 'b'])
+        running = {'a': [{'taskDefinition': 'fam:3',
+                          'deployments': [{'taskDefinition': 'fam:3'},
+                                          {'taskDefinition': 'fam:1'}]}],
+                   'b': [{'taskDefinition': 'fam:2'}]}
+
+        with mock.patch.object(Deployer, '_services', autospec=True,
+                               side_effect=lambda deployer: iter(running[deployer.cluster])):
+            assert deployer._task_definitions_in_use() == set(['fam:3', 'fam:2', 'fam:1'])
+
+        regional = deployer._region_deployers(['us-east-1'], ['a', 'b'])
+        assert regional['us-east-1', 'b'].args['region_clusters'] == ['a', 'b']
+
+    def test_deploy_keeps_results_when_collecting_fails(self):
+        ecs = FakeECS(1, 2, 2, 0)
+        ecs.list_task_definitions = mock.Mock(side_effect=ClientError(
+            {'Error': {'Code': 'AccessDeniedException'}}, 'ListTaskDefinitions'))
+        clock = VirtualClock()
+        deployer = Deployer(client=ecs, cluster='bench', service_name=['svc-00'],
+                            image='repo/app:2', journal=False, timeout=60, max_definitions=1)
+        deployer.poll_scheduler = lambda timeout: PollScheduler(timeout, clock=clock.clock,
+                                                                sleep=clock.sleep)
+        results = deployer.deploy()
+
+        assert [(r.service, r.status) for r in results] == [('svc-00', 'deployed')]
+        assert 'AccessDeniedException' in results[0].cause
+
+    def test_collect_task_definitions_dry_run(self):
+        mock_cli, client = self.setUp()
+        mock_cli.args['max_definitions'] = 1
+        mock_cli.args['dry_run'] = True
+        page = {'taskDefinitionArns': ['task-definition/mock_task:2',
+                                       'task-definition/mock_task:1']}
+
+        with mock.patch.object(mock_cli, '_services', return_value=iter([])), \
+                mock.patch.object(mock_cli, 'client_fn', return_value=page) as mock_fn:
+            assert mock_cli._collect_task_definitions('mock_task') == \
+                ['task-definition/mock_task:1']
+
+        mock_fn.assert_called_once_with('list_task_definitions', familyPrefix='mock_task')
+
+    def test_services_pages_and_batches(self):
+        mock_cli, client = self.setUp()
+        pages = {
+            None: {'serviceArns': ['service-%02d' % i for i in range(12)], 'nextToken': 'next'},
+            'next': {'serviceArns': ['service-12']}
+        }
+
+        def mock_client_fn(fn, **kwargs):
+            if fn == 'list_services':
+                return pages[kwargs.get('nextToken')]
+            assert len(kwargs['services']) <= MAX_DESCRIBE_SERVICES
+            return {'services': [{'serviceArn': arn} for arn in kwargs['services']]}
+
+        with mock.patch.object(mock_cli, 'client_fn', side_effect=mock_client_fn) as mock_fn:
+            services = list(mock_cli._services())
+
+        assert len(services) == 13
+        assert mock_fn.call_count == 5
+
+    def test_service_summary(self):
+        arn = 'arn:aws:ecs:us-east-1:123456789012:task-definition/web:%d'
+        placement = {'message': '(service web) was unable to place a task.', 'createdAt': 2}
+
+        def service(deployments, running=2, events=()):
+            return {'serviceName': 'web', 'status': 'ACTIVE', 'taskDefinition': arn % 2,
+                    'desiredCount': 2, 'runningCount': running, 'pendingCount': 0,
+                    'deployments': deployments, 'events': list(events)}
+
+        primary = {'status': 'PRIMARY', 'taskDefinition': arn % 2, 'rolloutState': 'COMPLETED'}
+        active = {'status': 'ACTIVE', 'taskDefinition': arn % 1}
+        summary = service_summary(service([primary]), latest_arn=arn % 3)
+        assert (summary['state'], summary['revision'], summary['outdated'],
+                summary['event']) == ('steady', 'web:2', True, None)
+        assert service_summary(service([primary]))['outdated'] is None
+        assert service_summary(service([primary], running=1))['state'] == 'degraded'
+        assert service_summary(service([primary, active]))['state'] == 'rolling out'
+        summary = service_summary(service([primary, active], events=[placement]))
+        assert (summary['state'], summary['event'], summary['deployments']) == \
+            ('stuck', placement['message'], 2)
+        failed = dict(primary, rolloutState='FAILED')
+        assert service_summary(service([failed, active]))['state'] == 'failed'
+
+        table = format_status([summary, service_summary(service([primary]), arn % 3)])
+        assert table.splitlines()[0].split() == \
+            ['SERVICE', 'STATE', 'REVISION', 'RUNNING', 'DEPLOYMENTS', 'LATEST', 'EVENT']
+        assert 'web:2 (latest 3)' in table.splitlines()[2]
+
+    def test_status_describes_every_service_in_batches(self):
+        mock_cli, client = self.setUp()
+        mock_cli.args['service_name'] = None
+        mock_cli.args['latest_revisions'] = True
+        arns = ['service/svc-%02d' % i for i in range(25)]
+        pages = {None: {'serviceArns': arns[:20], 'nextToken': 'next'},
+                 'next': {'serviceArns': arns[20:]}}
+
+        def mock_client_fn(fn, **kwargs):
+            if fn == 'list_services':
+                return pages[kwargs.get('nextToken')]
+            if fn == 'describe_task_definition':
+                return {'taskDefinition': {'taskDefinitionArn': 'task-definition/%s:2' %
+                                           kwargs['taskDefinition']}}
+            assert len(kwargs['services']) <= MAX_DESCRIBE_SERVICES
+            # svc-00 to svc-09 run web, the others worker; every third an old revision
+            return {'services': [{'serviceName': arn.split('/')[-1], 'desiredCount': 1,
+                                  'runningCount': 1, 'taskDefinition': 'task-definition/%s:%d'
+                                  % ('web' if i < 10 else 'worker', 1 if i % 3 == 0 else 2),
+                                  'deployments': [{'status': 'PRIMARY'}]}
+                                 for i, arn in ((int(arn[-2:]), arn)
+                                                for arn in kwargs['services'])]}
+
+        with mock.patch.object(mock_cli, 'client_fn', side_effect=mock_client_fn) as mock_fn:
+            summaries = mock_cli.status()
+
+        assert [summary['service'] for summary in summaries] == \
+            ['svc-%02d' % i for i in range(25)]
+        assert [summary['outdated'] for summary in summaries] == [i % 3 == 0 for i in range(25)]
+        calls = [call[0][0] for call in mock_fn.call_args_list]
+        assert (calls.count('list_services'), calls.count('describe_services'),
+                calls.count('describe_task_definition')) == (2, 3, 2)
+
+    def test_run_parser_status_json(self, capsys):
+        mock_cli, client = self.setUp()
+        mock_cli.args['status_format'] = 'json'
+        summary = {'service': 'web', 'state': 'steady'}
+
+        with mock.patch.object(CLI, 'status', return_value=[summary]):
+            mock_cli.args['command'] = 'status'
+            assert mock_cli._run_parser() == 0
+
+        assert json.loads(capsys.readouterr().out) == [
+            dict(summary, region=None, cluster=mock_cli.args['cluster'])]
+
+    def test_plan_and_apply(self):
+        ecs = FakeECS(3, 2, 2, 0)
+        for fn in ('describe_services', 'describe_task_definition', 'register_task_definition',
+                   'update_service'):
+            setattr(ecs, fn, mock.Mock(side_effect=getattr(ecs, fn)))
+        names = ['svc-00', 'svc-01', 'svc-02']
+        planner = Deployer(client=ecs, cluster='bench', service_name=names, image='repo/app:2',
+                           min=50, journal=False)
+        plan = json.loads(json.dumps(planner.plan()))
+
+        # one batched describe_services, one describe_task_definition per family
+        assert ecs.describe_services.call_count == 1
+        assert ecs.describe_task_definition.call_count == 3
+        assert not ecs.register_task_definition.called
+        entry = plan['services'][0]
+        assert (plan['cluster'], entry['service'], entry['action']) == \
+            ('bench', 'svc-00', 'register')
+        assert entry['containerDefinitions'][0]['image'] == 'repo/app:2'
+        assert entry['update_service'] == \
+            {'deploymentConfiguration': {'minimumHealthyPercent': 50}}
+        assert entry['diff'] == ['app.image: "repo/app:1" -> "repo/app:2"',
+                                 'deploymentConfiguration.minimumHealthyPercent: None -> 50']
+
+        clock = VirtualClock()
+        applier = Deployer(client=ecs, journal=False, timeout=60)
+        applier.poll_scheduler = lambda timeout: PollScheduler(timeout, clock=clock.clock,
+                                                               sleep=clock.sleep)
+        results = applier.apply(plan)
+
+        assert [(r.service, r.status) for r in results] == [(name, 'deployed') for name in names]
+        calls = [call['call'] for call in applier.metrics.calls]
+        assert 'describe_task_definition' not in calls
+        assert calls.count('register_task_definition') == 3
+        ecs.update_service.assert_any_call(
+            cluster='bench', service='svc-00',
+            taskDefinition='arn:aws:ecs:us-east-1:123456789012:task-definition/svc-00:2',
+            deploymentConfiguration={'minimumHealthyPercent': 50})
+
+        # a plan that only changes the desired count still updates the service
+        planner.args.update(image='repo/app:2', desired_count=4, min=None)
+        entry = planner.plan()['services'][0]
+        assert (entry['action'], entry['diff'], entry['update_service']['desiredCount']) == \
+            ('update', ['desiredCount: 2 -> 4'], 4)
+
+        # the services now run other revisions than the plan recorded
+        ecs.register_task_definition.reset_mock()
+        with pytest.raises(DeployError) as excinfo:
+            applier.apply(plan)
+        assert 'svc-00, svc-01, svc-02' in str(excinfo.value)
+        assert not ecs.register_task_definition.called
+
+    def test_run_parser_plan_and_apply(self, capsys):
+        mock_cli, client = self.setUp()
+        plan_dir = tempfile.mkdtemp()
+        mock_cli.args['plan_file'] = os.path.join(plan_dir, 'release.plan')
+        plan = {'version': 1, 'region': 'us-east-1', 'cluster': 'mock_cluster', 'services': [
+            {'service': 'web', 'family': 'web', 'action': 'register',
+             'diff': ['app.image: "repo/app:1" -> "repo/app:2"']},
+            {'service': 'worker', 'family': 'worker', 'action': 'none', 'diff': []}]}
+        try:
+            with mock.patch.object(CLI, 'plan', return_value=plan):
+                mock_cli.args['command'] = 'plan'
+                assert mock_cli._run_parser() == 0
+            assert capsys.readouterr().out.splitlines()[:3] == [
+                'web: new revision of web', '  app.image: "repo/app:1" -> "repo/app:2"',
+                'worker: no changes']
+
+            result = DeployResult('web', 'web:2', 'deployed', 1.0, None)
+            with mock.patch.object(CLI, 'apply', return_value=[result]) as mock_apply:
+                mock_cli.args['command'] = 'apply'
+                assert mock_cli._run_parser() == 0
+            mock_apply.assert_called_once_with(plan)
+            assert mock_cli.args['region'] == 'us-east-1'
+        finally:
+            shutil.rmtree(plan_dir)
+
+    def test_task_definition_cache_evicts_least_recently_used(self):
+        cache_dir = tempfile.mkdtemp()
+        definition = {'family': 'mock_task', 'containerDefinitions': [{'image': 'x' * 100}]}
+        size = len(json.dumps(dict(definition, taskDefinitionArn='arn:1'),
+                              separators=(',', ':')))
+        cache = TaskDefinitionCache(os.path.join(cache_dir, 'cache.sqlite'), size * 2)
+
+        cache.put(dict(definition, taskDefinitionArn='arn:1'))
+        cache.put(dict(definition, taskDefinitionArn='arn:2'))
+        assert cache.get('arn:1')['taskDefinitionArn'] == 'arn:1'
+        cache.put(dict(definition, taskDefinitionArn='arn:3'))
+
+        assert cache.get('arn:1') is not None
+        assert cache.get('arn:2') is None
+        assert cache.get('arn:3') is not None
+        shutil.rmtree(cache_dir)
+
+    def test_describe_task_definition_uses_cache_for_revision_arns(self):
+        mock_cli, client = self.setUp()
+        mock_cli.args['cache_dir'] = tempfile.mkdtemp()
+        mock_cli.args['task_definition_cache_size'] = 1
+        arn = mock_cli.task_definition['taskDefinitionArn']
+        response = {'taskDefinition': {'taskDefinitionArn': arn, 'family': 'mock_task'}}
+
+        with mock.patch.object(mock_cli, 'client_fn', return_value=response) as mock_fn:
+            mock_cli.task_definition_name = arn
+            assert mock_cli._describe_task_definition() == response['taskDefinition']
+            assert mock_cli._describe_task_definition() == response['taskDefinition']
+            assert mock_fn.call_count == 1
+
+            # a family name always goes to the API
+            mock_cli.task_definition_name = 'mock_task'
+            mock_cli._describe_task_definition()
+            assert mock_fn.call_count == 2
+
+        shutil.rmtree(mock_cli.args['cache_dir'])
+
+    @mock_ecs
+    def test_journal_records_deploys_for_rollback(self):
+        mock_cli, client = self.setUp()
+        mock_cli.args['cache_dir'] = tempfile.mkdtemp()
+        mock_cli.args['journal'] = True
+        mock_cli.cluster = mock_cli.args['cluster']
+        old_arn = client.describe_services(
+            cluster='mock_cluster',
+            services=['mock_task-service'])['services'][0]['taskDefinition']
+
+        deployment = mock_cli._deployment('mock_task-service')
+        assert deployment._start()
+        new_arn = deployment.new_task_definition['taskDefinitionArn']
+        deploy = mock_cli.journal.last_rollout(('us-east-1', 'mock_cluster', 'mock_task-service'))
+        assert (deploy['old_arn'], deploy['new_arn'], deploy['phase']) == \
+            (old_arn, new_arn, 'update')
+
+        # a rollback is a single update_service call, straight from the journal
+        with mock.patch.object(Deployer, 'client_fn', autospec=True,
+                               side_effect=Deployer.client_fn) as mock_fn:
+            results = mock_cli.rollback()
+        assert [c[0][1] for c in mock_fn.call_args_list] == ['update_service']
+        assert mock_fn.call_args[1] == {'taskDefinition': old_arn}
+        assert results == [DeployResult('mock_task-service', old_arn, 'rolled_back',
+                                        results[0].elapsed, None)]
+        assert client.describe_services(
+            cluster='mock_cluster', services=['mock_task-service'])['services'][0][
+                'taskDefinition'] == old_arn
+
+        # the deploy was rolled back, and nothing is left to roll back
+        assert mock_cli.rollback()[0].status == 'failed'
+
+        shutil.rmtree(mock_cli.args['cache_dir'])
+
+    @mock_ecs
+    def test_journal_resumes_interrupted_deploy(self):
+        mock_cli, client = self.setUp()
+        mock_cli.args['cache_dir'] = tempfile.mkdtemp()
+        mock_cli.args['journal'] = True
+        mock_cli.cluster = mock_cli.args['cluster']
+        arn = mock_cli.task_definition['taskDefinitionArn']
+        target = ('us-east-1', 'mock_cluster', 'mock_task-service')
+        mock_cli.journal.start(target, 'mock_image', arn, arn)
+
+        with mock.patch.object(Deployer, 'client_fn', autospec=True,
+                               side_effect=Deployer.client_fn) as mock_fn:
+            deployment = mock_cli._deployment('mock_task-service')
+            assert deployment._start()
+
+        # registration had finished, so only update_service is left to do
+        assert [c[0][1] for c in mock_fn.call_args_list] == ['update_service']
+        assert deployment.new_task_definition['taskDefinitionArn'] == arn
+        assert mock_cli.journal.last_rollout(target)['id'] == deployment.journal_id
+
+        # a deploy of another image starts afresh
+        assert mock_cli.journal.interrupted(target, 'other_image') is None
+
+        shutil.rmtree(mock_cli.args['cache_dir'])
+
+    def test_journal_target_uses_client_region(self):
+        client = mock.Mock()
+        client.meta.region_name = 'eu-west-1'
+        deployer = Deployer(client=client, cluster='production1')
+        assert deployer._journal_target('web') == ('eu-west-1', 'production1', 'web')
+
+    def test_rollout_placements(self):
+        service = {'desiredCount': 2, 'deploymentConfiguration': {'minimumHealthyPercent': 100}}
+        assert rollout_placements(service) == 1
+        assert rollout_placements(service, minimum_healthy_percent=50) == 0
+        assert rollout_placements(service, desired_count=5, minimum_healthy_percent=50) == 3
+        assert rollout_placements({'desiredCount': 0}) == 0
+
+    def test_task_reservation(self):
+        mock_cli, client = self.setUp()
+        assert task_reservation(mock_cli.task_definition) == (123, 123)
+        assert task_reservation({'containerDefinitions': [{'cpu': 128, 'memory': 512},
+                                                          {'memoryReservation': 256}]}) == \
+            (128, 768)
+        assert task_reservation({'cpu': '1024', 'memory': '2048',
+                                 'containerDefinitions': [{'cpu': 128}]}) == (1024, 2048)
+
+    def test_cluster_capacity_places_first_fit(self):
+        capacity = ClusterCapacity(lambda: [[1024, 2048], [256, 256]])
+        assert capacity.place(512, 1024, 3) == 2
+        assert capacity.place(256, 256, 2) == 1
+        assert capacity.place(1, 1, 1) == 0
+        assert ClusterCapacity(lambda: []).place(1, 1, 1) is None
+
+    def test_check_capacity(self):
+        mock_cli, client = self.setUp()
+        mock_cli.args['capacity_check'] = 'fail'
+        mock_cli.cluster = 'mock_cluster'
+        mock_cli.service_name = 'mock_task-service'
+        mock_cli.new_task_definition = mock_cli.task_definition
+        arns = ['arn:instance/%d' % i for i in range(150)]
+        instance = {'agentConnected': True,
+                    'remainingResources': [{'name': 'CPU', 'integerValue': 100},
+                                           {'name': 'MEMORY', 'integerValue': 4096}]}
+        responses = {
+            'list_container_instances': {'containerInstanceArns': arns},
+            'describe_container_instances': {'containerInstances': [instance]},
+            'describe_services': {'services': [{'desiredCount': 1}]},
+        }
+
+        with mock.patch.object(mock_cli, 'client_fn',
+                               side_effect=lambda fn, **kwargs: responses[fn]) as mock_fn:
+            mock_cli.cluster_capacity = ClusterCapacity(mock_cli._free_capacity)
+            with pytest.raises(DeployError):
+                mock_cli._check_capacity()
+
+            batches = [c[1]['containerInstances'] for c in mock_fn.call_args_list
+                       if c[0][0] == 'describe_container_instances']
+            assert sorted(len(batch) for batch in batches) == [50, 100]
+
+            # warn only records why the rollout may stall
+            mock_cli.args['capacity_check'] = 'warn'
+            mock_cli._check_capacity()
+            assert 'room for 0 of the 1 new tasks' in mock_cli.capacity_warning
+
+    def test_image_resolver_batches_per_repository(self):
+        registry = '123456789012.dkr.ecr.us-east-1.amazonaws.com'
+        images = ['%s/web:1' % registry, '%s/web:2' % registry, '%s/web' % registry,
+                  '%s/worker:1' % registry, 'mariadb:10', '%s/web@sha256:0' % registry]
+
+        def call(region, fn, **kwargs):
+            assert (region, fn, kwargs['registryId']) == \
+                ('us-east-1', 'batch_get_image', '123456789012')
+            return {'images': [{'imageId': {'imageTag': i['imageTag'],
+                                            'imageDigest': 'sha256:%s' % i['imageTag']}}
+                               for i in kwargs['imageIds']], 'failures': []}
+
+        cache_dir = tempfile.mkdtemp()
+        cache_path = os.path.join(cache_dir, 'digests.json')
+        mock_call = mock.Mock(side_effect=call)
+        resolver = ImageResolver(mock_call, cache_path)
+
+        pinned = resolver.resolve(images)
+        assert mock_call.call_count == 2
+        assert pinned == {
+            images[0]: '%s/web@sha256:1' % registry, images[1]: '%s/web@sha256:2' % registry,
+            images[2]: '%s/web@sha256:latest' % registry,
+            images[3]: '%s/worker@sha256:1' % registry,
+            images[4]: images[4], images[5]: images[5]}
+
+        # reused for the rest of the run, and by later runs through the cache
+        assert resolver.resolve(images[:1]) == {images[0]: pinned[images[0]]}
+        assert ImageResolver(mock_call, cache_path).resolve(images) == pinned
+        assert mock_call.call_count == 2
+        ImageResolver(mock_call, cache_path, ttl=0).resolve(images[:1])
+        assert mock_call.call_count == 3
+
+        shutil.rmtree(cache_dir)
+
+    def test_image_resolver_fails_on_unknown_tags(self):
+        call = mock.Mock(return_value={'images': [], 'failures': [
+            {'imageId': {'imageTag': '9'}, 'failureReason': 'Requested image not found'}]})
+        resolver = ImageResolver(call)
+        with pytest.raises(DeployError):
+            resolver.resolve(['123456789012.dkr.ecr.us-east-1.amazonaws.com/web:9'])
+
+    def test_image_repository(self):
+        assert image_repository('mariadb') == 'mariadb'
+        assert image_repository('silintl/mariadb:latest') == 'silintl/mariadb'
+        assert image_repository('private.registry.com:8000/repo/image:tag') == \
+            'private.registry.com:8000/repo/image'
+        assert image_repository('private.registry.com:8000/repo/image') == \
+            'private.registry.com:8000/repo/image'
+        assert image_repository('repo/image@sha256:0') == 'repo/image'
+
+    def test_container_index(self):
+        assert container_index({'containerDefinitions': [
+            {'image': 'repo/app:1'}, {'image': 'repo/proxy:3'}, {'image': 'repo/app:1'}]}) == \
+            {'repo/app': [0, 2], 'repo/proxy': [1]}
+
+    def test_client_kwargs_updates_containers_by_repository(self):
+        mock_cli, client = self.setUp()
+        mock_cli.task_definition = {
+            'taskDefinitionArn': 'task-definition/mock_task:1', 'family': 'mock_task',
+            'containerDefinitions': [{'name': 'app', 'image': 'repo/app:1'},
+                                     {'name': 'proxy', 'image': 'repo/proxy:3'},
+                                     {'name': 'log', 'image': 'repo/log:5'}]}
+        mock_cli.args['image'] = ['repo/proxy:4', 'repo/app:2']
+
+        with mock.patch('ecs_deploy.container_index', side_effect=container_index) as index:
+            for _ in range(2):
+                kwargs = mock_cli.client_kwargs('register_task_definition')
+
+        assert [c['image'] for c in kwargs['containerDefinitions']] == \
+            ['repo/app:2', 'repo/proxy:4', 'repo/log:5']
+        # the index is built once per revision
+        assert index.call_count == 1
+
+        mock_cli.args['image'] = ['repo/app:2', 'repo/sidecar:1']
+        with pytest.raises(DeployError):
+            mock_cli.client_kwargs('register_task_definition')
+
+    def test_ecr_clients_are_built_once_per_region(self):
+        deployer = Deployer(client=mock.Mock())
+        built = []
+
+        def mock_create_client(session=None, service='ecs', region=None):
+            built.append(region)
+            time.sleep(0.01)
+            return mock.Mock()
+
+        with mock.patch.object(deployer, '_create_client', side_effect=mock_create_client):
+            threads = [threading.Thread(target=deployer._ecr_call,
+                                        args=('us-east-1', 'batch_get_image'))
+                       for _ in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        assert built == ['us-east-1']
+
+    def test_clients_are_built_under_client_lock(self):
+        session = mock.Mock()
+        session.client.side_effect = lambda *args, **kwargs: client_lock.locked()
+        assert Deployer(session=session).client
+
+    def test_client_kwargs_pins_image(self):
+        mock_cli, client = self.setUp()
+        mock_cli.image_resolver = mock.Mock()
+        mock_cli.image_resolver.resolve.return_value = {'mock_image': 'mock_image@sha256:0'}
+        kwargs = mock_cli.client_kwargs('register_task_definition')
+        assert kwargs['containerDefinitions'][0]['image'] == 'mock_image@sha256:0'
+
+    def test_cassette_replay(self):
+        mock_cli, client = self.setUp()
+        cassette_dir = tempfile.mkdtemp()
+        path = os.path.join(cassette_dir, 'cassette.jsonl')
+        mock_cli.cassette = Cassette(path)
+        mock_cli.args['max_retries'] = 0
+        mock_cli.cluster = 'mock_cluster'
+        mock_cli.client = mock.Mock()
+        mock_cli.client.describe_services.side_effect = [{'services': [1]}, {'services': [2]}]
+        mock_cli.client.list_services.side_effect = ClientError(
+            {'Error': {'Code': 'ClusterNotFoundException', 'Message': 'bad'}}, 'ListServices')
+
+        for _ in range(2):
+            mock_cli.client_fn('describe_services', services=['a'])
+        with pytest.raises(ClientCallError):
+            mock_cli.client_fn('list_services')
+
+        replay = ReplayClient(path)
+        # recorded responses in order, then the last one again
+        assert [replay.describe_services(cluster='mock_cluster', services=['a'])
+                for _ in range(3)] == [{'services': [1]}, {'services': [2]}, {'services': [2]}]
+        with pytest.raises(ClientError):
+            replay.list_services(cluster='mock_cluster', maxResults=100)
+        with pytest.raises(DeployError):
+            replay.describe_services(cluster='mock_cluster', services=['b'])
+
+        shutil.rmtree(cassette_dir)
+
+    def daemon(self, services=2, **options):
+        # a daemon deploying to a simulated cluster, polling every 10ms
+        ecs = FakeECS(services, 2, 3, 0)
+        ecs.describe_services = mock.Mock(side_effect=ecs.describe_services)
+        session = mock.Mock()
+        session.client.return_value = ecs
+        options = dict(dict(cluster='bench', image='repo/app:2', timeout=60,
+                            failure_threshold=3), **options)
+        return DeployDaemon(session=session, **options), ecs
+
+    def test_daemon_shares_polls_between_jobs(self):
+        scheduler = staticmethod(lambda timeout: PollScheduler(timeout, min_interval=0.01,
+                                                               max_interval=0.01))
+        with mock.patch.object(Deployer, 'poll_scheduler', scheduler):
+            daemon, ecs = self.daemon()
+            jobs = [daemon.submit({'service_name': name}) for name in ('svc-00', 'svc-01')]
+            events = [list(job.follow()) for job in jobs]
+
+        assert [job.status for job in jobs] == ['done', 'done']
+        assert all(job.ok for job in jobs)
+        assert [result.status for job in jobs for result in job.results] == \
+            ['deployed', 'deployed']
+        assert all(events) and all(service == 'svc-00' for service, _ in events[0])
+        # one client for the region, and the rollouts were watched together
+        assert len(daemon.regions) == 1 and len(daemon.watchers) == 1
+        assert any(c[1]['services'] == ['svc-00', 'svc-01']
+                   for c in ecs.describe_services.call_args_list)
+
+        with pytest.raises(DeployError):
+            daemon.submit({'service_name': 'svc-00', 'profile': 'other'})
+        with pytest.raises(DeployError):
+            daemon.submit({'cluster': 'bench'})
+
+    def test_daemon_http_api(self):
+        try:
+            from urllib.request import urlopen, Request
+        except ImportError:
+            from urllib2 import urlopen, Request
+
+        scheduler = staticmethod(lambda timeout: PollScheduler(timeout, min_interval=0.01,
+                                                               max_interval=0.01))
+        daemon, ecs = self.daemon(services=1)
+        server = daemon_server(daemon, '127.0.0.1:0')
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        url = 'http://127.0.0.1:%d/jobs' % server.server_address[1]
+        try:
+            with mock.patch.object(Deployer, 'poll_scheduler', scheduler):
+                job = json.loads(urlopen(Request(
+                    url, json.dumps({'service_name': 'svc-00'}).encode('utf-8'),
+                    {'Content-Type': 'application/json'})).read().decode('utf-8'))
+                assert job['status'] in ('queued', 'running')
+
+                lines = urlopen('%s/%s/events' % (url, job['id'])).read().decode('utf-8')
+                lines = [json.loads(line) for line in lines.splitlines()]
+            assert all(line['service'] == 'svc-00' for line in lines[:-1])
+            assert lines[-1]['ok'] and lines[-1]['results'][0]['status'] == 'deployed'
+
+            job = json.loads(urlopen('%s/%s' % (url, job['id'])).read().decode('utf-8'))
+            assert job['status'] == 'done'
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+    def test_daemon_unix_socket_is_owner_only(self):
+        import stat
+        socket_dir = tempfile.mkdtemp()
+        path = os.path.join(socket_dir, 'run', 'daemon.sock')
+        daemon, ecs = self.daemon(services=1)
+        server = daemon_server(daemon, path)
+        try:
+            assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+        finally:
+            server.server_close()
+            shutil.rmtree(socket_dir)
+
+    def test_serve_listens_in_cache_dir(self):
+        mock_cli, client = self.setUp()
+        cache_dir = tempfile.mkdtemp()
+        mock_cli.args.update(command='serve', cache_dir=cache_dir, listen=None)
+        mock_cli.session = mock.Mock()
+
+        with mock.patch('ecs_deploy.daemon_server') as mock_daemon_server, \
+                mock.patch('ecs_deploy.DeployDaemon'):
+            mock_daemon_server.return_value.serve_forever.side_effect = KeyboardInterrupt
+            assert mock_cli._run_parser() == 0
+        shutil.rmtree(cache_dir)
+
+        assert mock_daemon_server.call_args[0][1] == os.path.join(cache_dir, 'daemon.sock')
+
+    def test_daemon_jobs_keep_their_own_metrics(self):
+        scheduler = staticmethod(lambda timeout: PollScheduler(timeout, min_interval=0.01,
+                                                               max_interval=0.01))
+        daemon, ecs = self.daemon(services=1)
+        metrics = []
+        deploy = Deployer.deploy
+
+        def mock_deploy(deployer):
+            metrics.append(deployer.metrics)
+            return deploy(deployer)
+
+        with mock.patch.object(Deployer, 'poll_scheduler', scheduler), \
+                mock.patch.object(Deployer, 'deploy', autospec=True, side_effect=mock_deploy):
+            for _ in range(2):
+                job = daemon.submit({'service_name': 'svc-00'})
+                list(job.follow())
+                assert job.ok
+
+        # each job's metrics go with it; the daemon's own deployers keep none
+        assert metrics[0] is not metrics[1] and metrics[0].calls
+        assert daemon.regions[None].metrics is None
+        assert all(watcher.deployer.metrics is None for watcher in daemon.watchers.values())
+
+    def test_credential_cache(self):
+        import fcntl
+        from datetime import timedelta
+        from dateutil.tz import tzutc
+
+        cache_dir = tempfile.mkdtemp()
+        cache = CredentialCache(cache_dir, 'ops--', margin=900)
+        expiring = datetime.now(tzutc()) + timedelta(minutes=10)
+        response = {'Credentials': {'AccessKeyId': 'a', 'SecretAccessKey': 's',
+                                    'SessionToken': 't', 'Expiration': expiring}}
+
+        # a miss holds the key's lock until the fetched credentials are stored
+        assert 'role' not in cache
+        fd = os.open(os.path.join(cache_dir, 'ops--role.lock'), os.O_RDWR)
+        with pytest.raises(IOError):
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        cache['role'] = response
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+        assert oct(os.stat(os.path.join(cache_dir, 'ops--role.json')).st_mode & 0o777) == \
+            oct(0o600)
+
+        # within the refresh margin of expiring is a miss; a miss that is never
+        # stored only holds up others for lock_timeout
+        assert 'role' not in CredentialCache(cache_dir, 'ops--', margin=900)
+        fresh = CredentialCache(cache_dir, 'ops--', margin=300, lock_timeout=0.1)
+        assert 'role' in fresh
+        assert fresh['role']['Credentials']['AccessKeyId'] == 'a'
+        assert 'role' not in CredentialCache(cache_dir, 'other--', margin=300)
+
+        shutil.rmtree(cache_dir)
+
+    def test_create_client_with_credential_cache(self):
+        mock_cli, client = self.setUp()
+        mock_cli.args.update(profile='ops', credential_cache=True, cache_dir=tempfile.mkdtemp())
+        with mock.patch('boto3.session.Session') as mock_session:
+            mock_cli._create_client()
+        provider = mock_session.return_value._session.get_component.return_value \
+            .get_provider.return_value
+        assert isinstance(provider.cache, CredentialCache)
+        assert provider.cache.prefix == 'ops--'
+        assert provider.cache.margin == 900
+
+        shutil.rmtree(mock_cli.args['cache_dir'])
+
+    def test_client_fn_raises_client_call_error(self):
+        mock_cli, client = self.setUp()
+        mock_cli.client = client
+        error = ClientError({'Error': {'Code': 'ClusterNotFoundException'}}, 'ListServices')
+
+        with mock.patch.object(client, 'list_services', side_effect=error):
+            with pytest.raises(ClientCallError) as excinfo:
+                mock_cli.client_fn('list_services')
+
+        assert excinfo.value.fn == 'list_services'
+        assert excinfo.value.error is error
+
+    def test_deployer_uses_injected_client(self):
+        mock_client = mock.Mock()
+        deployer = Deployer(client=mock_client, cluster='mock_cluster')
+
+        assert deployer.client is mock_client
+
+    def test_deployer_sizes_connection_pool_for_workers(self):
+        session = mock.Mock()
+        Deployer(session=session, cluster='mock_cluster', workers=40).client
+
+        config = session.client.call_args[1]['config']
+        assert config.max_pool_connections == 40
+
+    def test_deployer_deploy_results(self):
+        deployer = Deployer(client=mock.Mock(), cluster='mock_cluster',
+                            service_name=['service-a', 'service-b', 'service-c'])
+
+        def mock_start(deployment):
+            name = deployment.args['service_name']
+            if name == 'service-c':
+                raise DeployError('no such service')
+            deployment.service_name = name
+            deployment.new_task_definition = {'taskDefinitionArn': 'arn/%s:2' % name}
+            return True
+
+        with mock.patch.object(Deployer, '_start', autospec=True, side_effect=mock_start), \
+                mock.patch.object(Deployer, '_watch', return_value=(
+                    {'service-a': time.time()}, {'service-b': 'task stopped'})):
+            results = deployer.deploy()
+
+        assert [(r.service, r.status, r.cause) for r in results] == [
+            ('service-a', 'deployed', None),
+            ('service-b', 'failed', 'task stopped'),
+            ('service-c', 'failed', 'no such service')]
+        assert [r.ok for r in results] == [True, False, False]
+
+    def test_import_time(self):
+        # importing the script must not load boto3/botocore; keep its total
+        # import time well below the few hundred milliseconds boto3 costs.
+        # The import is timed in a fresh interpreter, as -X importtime needs
+        # Python 3.7
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.Popen(
+            [sys.executable, '-c',
+             'import sys, time; start = time.time(); import ecs_deploy; '
+             'print(int((time.time() - start) * 1000000)); '
+             'print([m for m in sys.modules if m.split(".")[0] in ("boto3", "botocore")])'],
+            cwd=root, stdout=subprocess.PIPE).communicate()[0].decode('utf-8')
+
+        elapsed, modules = output.splitlines()[-2:]
+        assert modules == '[]'
+        assert int(elapsed) < IMPORT_TIME_BUDGET_US
+
+    def test_client_is_built_lazily(self):
+        session = mock.Mock()
+        deployer = Deployer(session=session, cluster='mock_cluster')
+
+        assert not session.client.called
+        assert deployer.client is session.client.return_value
+        assert deployer._deployment('service-a').client is deployer.client
+        assert session.client.call_count == 1
+
+    def test_client_fn_records_metrics(self):
+        mock_cli, client = self.setUp()
+        mock_cli.metrics = Metrics()
+        response = {'serviceArns': [], 'ResponseMetadata': {
+            'RetryAttempts': 2, 'HTTPHeaders': {'content-length': '42'}}}
+
+        with mock.patch.object(client, 'list_services', return_value=response):
+            with mock_cli._phase('resolve'):
+                mock_cli.client_fn('list_services')
+
+        call, = mock_cli.metrics.calls
+        assert (call['call'], call['phase'], call['retries'], call['bytes'], call['error']) == \
+            ('list_services', 'resolve', 2, 42, None)
+        assert list(mock_cli.metrics.phase_totals()) == ['resolve']
+
+    def test_client_fn_records_failed_calls(self):
+        mock_cli, client = self.setUp()
+        mock_cli.metrics = Metrics()
+        mock_cli.args['max_retries'] = 0
+        error = ClientError({'Error': {'Code': 'ThrottlingException'},
+                             'ResponseMetadata': {'RetryAttempts': 4}}, 'ListServices')
+
+        with mock.patch.object(client, 'list_services', side_effect=error):
+            with pytest.raises(ClientCallError):
+                mock_cli.client_fn('list_services')
+
+        call, = mock_cli.metrics.calls
+        assert (call['retries'], call['error']) == (4, 'ClientError')
+
+    def test_metrics_write_formats(self):
+        metrics = Metrics()
+        metrics.record_call('describe_services', 'wait', 'service-a', 0.5, 1, 100)
+        metrics.record_call('describe_services', 'wait', 'service-b', 0.25, 0, 50)
+        metrics.record_phase('wait', 'service-a', 3.0)
+        metrics_dir = tempfile.mkdtemp()
+
+        path = os.path.join(metrics_dir, 'metrics.jsonl')
+        metrics.write(path)
+        with open(path) as f:
+            records = [json.loads(line) for line in f]
+        assert [r['type'] for r in records] == ['call', 'call', 'phase']
+
+        path = os.path.join(metrics_dir, 'metrics.prom')
+        metrics.write(path, 'prometheus')
+        with open(path) as f:
+            text = f.read()
+        assert 'ecs_deploy_api_calls_total{call="describe_services",phase="wait"} 2' in text
+        assert 'ecs_deploy_api_call_seconds_total{call="describe_services",phase="wait"} 0.75' \
+            in text
+        assert 'ecs_deploy_phase_seconds{phase="wait"} 3.0' in text
+        shutil.rmtree(metrics_dir)
+
+    def test_client_fn_retries_throttling(self):
+        mock_cli, client = self.setUp()
+        mock_cli.metrics = Metrics()
+        mock_cli.args['max_retries'] = 3
+        throttled = ClientError({'Error': {'Code': 'ThrottlingException'}}, 'ListServices')
+        server_error = ClientError({'Error': {'Code': 'ServerException'},
+                                    'ResponseMetadata': {'HTTPStatusCode': 500}}, 'ListServices')
+
+        with mock.patch.object(client, 'list_services',
+                               side_effect=[throttled, server_error, {'serviceArns': []}]), \
+                mock.patch('ecs_deploy.time.sleep') as mock_sleep:
+            assert mock_cli.client_fn('list_services') == {'serviceArns': []}
+
+        assert mock_sleep.call_count == 2
+        assert sorted(mock_cli.metrics.retry_totals()) == \
+            [('list_services', 'ServerException'), ('list_services', 'ThrottlingException')]
+
+    def test_client_fn_does_not_retry_client_errors(self):
+        mock_cli, client = self.setUp()
+        error = ClientError({'Error': {'Code': 'InvalidParameterException'},
+                             'ResponseMetadata': {'HTTPStatusCode': 400}}, 'ListServices')
+
+        with mock.patch.object(client, 'list_services', side_effect=error) as mock_call, \
+                mock.patch('ecs_deploy.time.sleep') as mock_sleep:
+            with pytest.raises(ClientCallError):
+                mock_cli.client_fn('list_services')
+
+        assert mock_call.call_count == 1
+        assert not mock_sleep.called
+
+    def test_token_bucket_paces_acquisitions(self):
+        now = [0.0]
+
+        def mock_sleep(delay):
+            now[0] += delay
+
+        bucket = TokenBucket(2, capacity=2, clock=lambda: now[0], sleep=mock_sleep)
+        for _ in range(6):
+            bucket.acquire()
+
+        # a burst of two, then one every half second
+        assert now[0] == 2.0
+
+    def test_rate_limiter_separates_reads_and_writes(self):
+        limiter = RateLimiter()
+        with mock.patch.object(limiter.read, 'acquire') as mock_read, \
+                mock.patch.object(limiter.write, 'acquire') as mock_write:
+            limiter.acquire('describe_services')
+            limiter.acquire('list_tasks')
+            limiter.acquire('update_service')
+
+        assert (mock_read.call_count, mock_write.call_count) == (2, 1)
+
+    def test_deploy_waves(self):
+        dependencies = OrderedDict([('web', ['api']), ('api', ['db']), ('db', []),
+                                    ('worker', ['db']), ('docs', [])])
+
+        assert deploy_waves(dependencies) == [['db', 'docs'], ['api', 'worker'], ['web']]
+
+    def test_deploy_waves_rejects_cycles_and_unknown_services(self):
+        with pytest.raises(DeployError):
+            deploy_waves({'web': ['api'], 'api': ['web']})
+        with pytest.raises(DeployError):
+            deploy_waves({'web': ['missing']})
+
+    def test_manifest_services(self):
+        manifest = {
+            'defaults': {'cluster': 'production1', 'minimumHealthyPercent': 50},
+            'services': [
+                {'service': 'api', 'image': 'repo/api:2'},
+                {'service': 'web', 'image': 'repo/web:2', 'desiredCount': 4,
+                 'maximumPercent': 200, 'dependsOn': ['api']}
+            ]
+        }
+        services = manifest_services(manifest)
+
+        assert list(services) == ['api', 'web']
+        assert services['web'] == ({'cluster': 'production1', 'service_name': ['web'],
+                                    'image': 'repo/web:2', 'desired_count': 4, 'min': 50,
+                                    'max': 200}, ['api'])
+        with pytest.raises(DeployError):
+            manifest_services({'services': [{'service': 'api', 'replicas': 2}]})
+
+    def test_deploy_manifest_orders_and_skips(self):
+        deployer = Deployer(client=mock.Mock(), cluster='production1')
+        manifest = {'services': [
+            {'service': 'web', 'image': 'repo/web:2', 'dependsOn': ['api']},
+            {'service': 'api', 'image': 'repo/api:2', 'dependsOn': ['db']},
+            {'service': 'db', 'image': 'repo/db:2'},
+            {'service': 'docs', 'image': 'repo/docs:2'},
+            {'service': 'admin', 'image': 'repo/admin:2', 'dependsOn': ['docs']}
+        ]}
+        deployed = []
+
+        def mock_deploy(deployer):
+            name = deployer.args['service_name'][0]
+            assert deployer.args['cluster'] == 'production1'
+            deployed.append(name)
+            status = 'failed' if name == 'api' else 'deployed'
+            return [DeployResult(name, 'arn:%s' % name, status, 1.0, None)]
+
+        with mock.patch.object(Deployer, 'deploy', autospec=True, side_effect=mock_deploy):
+            results = deployer.deploy_manifest(manifest)
+
+        assert [(r.service, r.status) for r in results] == [
+            ('web', 'skipped'), ('api', 'failed'), ('db', 'deployed'), ('docs', 'deployed'),
+            ('admin', 'deployed')]
+        assert deployed.index('db') < deployed.index('api')
+        assert deployed.index('docs') < deployed.index('admin')
+        assert 'web' not in deployed
+
+    def test_deploy_manifest_with_task_definition(self):
+        deployer = Deployer(client=mock.Mock(), cluster='production1', task_definition='other')
+        manifest = {'services': [
+            {'service': 'web', 'taskDefinition': 'web-task', 'image': 'repo/web:2'},
+            {'service': 'api', 'image': 'repo/api:2'}]}
+        task_definitions = {}
+
+        def mock_deploy(deployer):
+            name = deployer.args['service_name'][0]
+            task_definitions[name] = deployer.args['task_definition']
+            return [DeployResult(name, 'arn:%s' % name, 'deployed', 1.0, None)]
+
+        with mock.patch.object(Deployer, 'deploy', autospec=True, side_effect=mock_deploy):
+            results = deployer.deploy_manifest(manifest)
+
+        assert all(result.ok for result in results)
+        assert task_definitions == {'web': 'web-task', 'api': None}
+
+    def test_split_list(self):
+        assert split_list(['us-east-1,us-west-2', ' eu-west-1 ']) == \
+            ['us-east-1', 'us-west-2', 'eu-west-1']
+        assert split_list(None) == []
+
+    def test_deploy_regions_shares_client_per_region(self):
+        session = mock.Mock()
+        session.client.side_effect = \
+            lambda *args, **kwargs: mock.Mock(region=kwargs['region_name'])
+        deployer = Deployer(session=session, service_name=['web'])
+        seen = []
+
+        def mock_deploy(target):
+            seen.append((target.client.region, target.args['region'], target.cluster))
+            return [DeployResult('web', 'arn', 'deployed', 1.0, None)]
+
+        with mock.patch.object(Deployer, 'deploy', autospec=True, side_effect=mock_deploy):
+            results = deployer.deploy_regions(['us-east-1', 'eu-west-1'], ['blue', 'green'])
+
+        assert list(results) == [('us-east-1', 'blue'), ('us-east-1', 'green'),
+                                 ('eu-west-1', 'blue'), ('eu-west-1', 'green')]
+        assert session.client.call_count == 2
+        assert sorted(seen) == sorted((region, region, cluster) for region, cluster in results)
+
+    def test_deploy_regions_rejects_manifest_cluster(self):
+        deployer = Deployer(session=mock.Mock())
+        manifest = {'defaults': {'cluster': 'workers1'},
+                    'services': [{'service': 'web', 'image': 'repo/web:2'}]}
+
+        with mock.patch.object(Deployer, 'deploy_manifest') as mock_deploy_manifest:
+            with pytest.raises(DeployError):
+                deployer.deploy_regions(['us-east-1'], ['blue', 'green'], manifest=manifest)
+            deployer.deploy_regions(['us-east-1'], ['blue'], manifest=manifest)
+
+        assert mock_deploy_manifest.call_count == 1
+
+    def test_deploy_regions_canary_failure_skips_other_regions(self):
+        session = mock.Mock()
+        deployer = Deployer(session=session, service_name=['web'])
+        deployed = []
+
+        def mock_deploy(target):
+            deployed.append(target.args['region'])
+            return [DeployResult('web', None, 'failed', 1.0, 'task stopped')]
+
+        with mock.patch.object(Deployer, 'deploy', autospec=True, side_effect=mock_deploy):
+            results = deployer.deploy_regions(['us-east-1', 'eu-west-1', 'ap-south-1'], ['main'],
+                                              canary_region='eu-west-1')
+
+        assert deployed == ['eu-west-1']
+        assert [r.status for rs in results.values() for r in rs] == \
+            ['skipped', 'failed', 'skipped']